@@ -4,157 +4,890 @@ Daniel Goldblatt
 Algorithm for random student selection
 '''
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify
+from array import array
+from collections import OrderedDict
+import atexit
+import bisect
+import csv
+import json
+import os
 import random
+import sys
+import threading
+import time
 
-app = Flask(__name__)
+import numpy as np
 
-# Store class names and corresponding data
-classes = {
-    "Class 1": {
-        "names": [],
-        "selection_counts": {}
-    }
-}
+import roster
+from events import EventHub, encode_event
+from metrics import Metrics, SlowRequestProfiler
+from sampler import FenwickSampler
+from storage import LogStorage, NullStorage, SharedStorage
 
-# Helper function to get class data
-def get_class_data(class_name):
-    if class_name in classes:
-        return classes[class_name]["names"], classes[class_name]["selection_counts"]
-    return [], {}
+app = Flask(__name__)
+np_random = np.random.default_rng()
 
 # Core logic for name selection
 class NameSelector:
-    def __init__(self):
-        self.names = []  # List of names
-        self.selection_order = []  # Tracks order of selections
-        self.selection_counts = {}  # Tracks how many times each name is selected
+    __slots__ = (
+        "_names", "_table", "_size", "_counts", "sampler", "token", "version",
+        "_changed", "_changed_versions", "_base_version", "_payloads",
+    )
+    MAX_CACHED_PAYLOADS = 4
+    MAX_HOLES = 32  # Deleted slots kept before _names is compacted
+    MIN_CHANGES = 8  # Changes kept for deltas: an eighth of the names, at least this many
+    NAME_BYTES = 48  # About what one resident name costs, to count cached payloads as names
+
+    def __init__(self, sampler=None, token=None, version=0):
+        self._names = []  # Interned names in insertion order, None where one was deleted
+        self._table = array("i", [-1]) * 8  # Hash index into _names, see _slot
+        self._size = 0  # Names held, not counting deleted slots
+        self._counts = array("q")  # Tracks how many times each name is selected, by index
+        # Tracks order of selections and draws recency-weighted names, by index
+        self.sampler = sampler if sampler is not None else FenwickSampler()
+
+        # Versioned state: the token tells apart classes that reuse a name
+        self.token = token or new_token()
+        self.version = version
+        self._changed = []  # Names touched by recent changes, oldest first, with repeats
+        self._changed_versions = array("q")  # Version of each entry in _changed
+        self._base_version = version  # Deltas are only known after this version
+        self._payloads = None  # (version, {since: JSON}) for the current version
+
+    # Readers get copies and never change the selector; callers hold the class lock
+    @property
+    def names(self):
+        if len(self._names) == self._size:
+            return list(self._names)
+        return [name for name in self._names if name is not None]
+
+    @property
+    def selection_counts(self):
+        return {name: count for name, count in zip(self._names, self._counts) if name is not None}
+
+    @property
+    def selection_order(self):
+        names = self._names
+        return [names[index] for index in self.sampler.order()]
+
+    def count(self, name):
+        return self._counts[self._index(name)]
+
+    def __contains__(self, name):
+        return self._find(name) >= 0
+
+    def __len__(self):
+        return self._size
 
     def add_name(self, name):
-        if name and name not in self.names:
-            self.names.append(name)
-            self.selection_counts[name] = 0  # Initialize count
+        if not name:
+            return
+        slot = self._slot(name)
+        if self._table[slot] >= 0:
+            return
+        name = sys.intern(name)  # One copy of a name shared by every class
+        index = len(self._names)
+        if 3 * (index + 1) > 2 * len(self._table):
+            self._rehash(index + 1)
+            slot = self._slot(name)
+        self._table[slot] = index
+        self._names.append(name)
+        self._counts.append(0)  # Initialize count
+        self._size += 1
+        self.sampler.add(index)
+
+    def add_names(self, names):
+        for name in names:
+            self.add_name(name)
 
     def delete_name(self, name):
-        if name in self.names:
-            self.names.remove(name)
-            del self.selection_counts[name]
-
-    def select_name(self):
-        if not self.names:
+        index = self._find(name)
+        if index >= 0:
+            self._names[index] = None  # Its _table entry is skipped from now on
+            self._size -= 1
+            self.sampler.remove(index)
+            holes = len(self._names) - self._size
+            if holes > self.MAX_HOLES and holes > self._size:
+                self._compact()
+
+    def select_name(self, rng=None):
+        selected_name, error = self.draw_name(rng)
+        if error is None:
+            self.mark_selected(selected_name)
+        return selected_name, error
+
+    def draw_name(self, rng=None):
+        if not self._size:
             return None, "No names available to select."
 
-        # Assign weights inversely proportional to recency
-        weights = []
-        for name in self.names:
-            if name not in self.selection_order:
-                weights.append(1.0)  # High weight for unselected names
-            else:
-                recency = len(self.selection_order) - self.selection_order[::-1].index(name)
-                weights.append(1 / recency)
-
-        # Normalize weights and select a name
-        total_weight = sum(weights)
-        probabilities = [w / total_weight for w in weights]
-        selected_name = random.choices(self.names, weights=probabilities, k=1)[0]
+        # Weights are inversely proportional to recency, see sampler.py
+        return self._names[self.sampler.draw(rng if rng is not None else random)], None
 
+    def draw_names(self, k, replace=False, rng=None):
+        # Draws k names at once from the current weights, without updating them
+        if not self._size:
+            return None, "No names available to select."
+        if k < 1 or (not replace and k > self._size):
+            return None, "Cannot select %d names from %d." % (k, self._size)
+        indices, weights = self.sampler.weights()
+        rng = rng if rng is not None else np_random
+        picks = rng.choice(len(indices), size=k, replace=replace, p=weights / weights.sum())
+        names = self._names
+        return [names[indices[i]] for i in picks], None
+
+    def select_names(self, k, replace=False, rng=None):
+        selected_names, error = self.draw_names(k, replace, rng)
+        if error is None:
+            for name in selected_names:
+                self.mark_selected(name)
+        return selected_names, error
+
+    def simulate(self, draws, rng=None):
+        # Hits per name over independent draws from the current weights
+        if not self._size:
+            return None, "No names available to select."
+        indices, weights = self.sampler.weights()
+        rng = rng if rng is not None else np_random
+        picks = rng.choice(len(indices), size=draws, p=weights / weights.sum())
+        hits = np.bincount(picks, minlength=len(indices))
+        names = self._names
+        return dict(zip((names[index] for index in indices), hits.tolist())), None
+
+    def mark_selected(self, name):
         # Update order and counts
-        if selected_name in self.selection_order:
-            self.selection_order.remove(selected_name)
-        self.selection_order.append(selected_name)
-        self.selection_counts[selected_name] += 1
-
-        return selected_name, None
+        index = self._index(name)
+        self.sampler.touch(index)
+        self._counts[index] += 1
+
+    def reset(self):
+        self._names = []
+        self._table = array("i", [-1]) * 8
+        self._size = 0
+        self._counts = array("q")
+        self.sampler.clear()
+        self._changed = []
+        self._changed_versions = array("q")
+        self._base_version = self.version + 1
+
+    def record_change(self, names):
+        # Called once per applied mutation with the names it touched
+        self.version += 1
+        self._payloads = None
+        self._changed.extend(names)
+        self._changed_versions.extend(array("q", [self.version]) * len(names))
+        limit = max(self.MIN_CHANGES, self._size // 8)
+        if len(self._changed) > limit:
+            # Forget the oldest changes; older clients get the full state instead
+            cut = len(self._changed) - limit // 2
+            self._base_version = self._changed_versions[cut - 1]
+            del self._changed[:cut]
+            del self._changed_versions[:cut]
+
+    def footprint(self):
+        # Resident size in names, for the registry's cap: the names, the class
+        # itself, and its cached payloads
+        payloads = self._payloads
+        cached = sum(map(len, list(payloads[1].values()))) if payloads is not None else 0
+        return self._size + 1 + cached // self.NAME_BYTES
+
+    def cached_state(self, since=None):
+        payloads = self._payloads
+        payload = payloads[1].get(since) if payloads is not None else None
+        return payload and (payloads[0], payload)
+
+    def state_payload(self, since=None):
+        # JSON for the class state, or for the changes after `since`
+        if since is not None and not self._base_version <= since <= self.version:
+            since = None
+        cached = self.cached_state(since)
+        if cached:
+            return cached
+        if since is None:
+            state = {"full": True, "names": self.names, "counts": self.selection_counts}
+        else:
+            start = bisect.bisect_right(self._changed_versions, since)
+            changed, deleted = [], []
+            for name in dict.fromkeys(self._changed[start:]):
+                (changed if name in self else deleted).append(name)
+            changed.sort(key=self._index)
+            state = {
+                "full": False,
+                "since": since,
+                "changed": [[name, self.count(name)] for name in changed],
+                "deleted": deleted,
+            }
+        state["token"], state["version"] = self.token, self.version
+        payload = json.dumps(state, separators=(",", ":")).encode()
+        if self._payloads is None:
+            self._payloads = (self.version, {})
+        if len(self._payloads[1]) < self.MAX_CACHED_PAYLOADS:
+            self._payloads[1][since] = payload
+        return self.version, payload
+
+    def _slot(self, name):
+        # Open addressing, probed like CPython's dicts: _table holds indices
+        # into _names, -1 where empty. Returns the entry holding `name`, or
+        # the empty one it would go in; entries of deleted names are passed over.
+        table, names = self._table, self._names
+        mask = len(table) - 1
+        perturb = hash(name) & 0xFFFFFFFFFFFFFFFF
+        slot = perturb & mask
+        while True:
+            index = table[slot]
+            if index < 0 or names[index] == name:
+                return slot
+            perturb >>= 5
+            slot = (5 * slot + perturb + 1) & mask
+
+    def _find(self, name):
+        # Index of a name in _names, or -1
+        return self._table[self._slot(name)] if name is not None else -1
+
+    def _index(self, name):
+        index = self._find(name)
+        if index < 0:
+            raise KeyError(name)
+        return index
+
+    def _rehash(self, capacity):
+        # Rebuilds _table to hold `capacity` names at most two thirds full,
+        # like CPython's dicts, dropping deleted names' entries
+        size = 8
+        while 2 * size < 3 * capacity:
+            size *= 2
+        self._table = array("i", [-1]) * size
+        for index, name in enumerate(self._names):
+            if name is not None:
+                self._table[self._slot(name)] = index
+
+    def _compact(self):
+        # Drop the holes left by delete_name, once there are more holes than
+        # names; the sampler is rebuilt with the new indices
+        live = [index for index, name in enumerate(self._names) if name is not None]
+        renumbered = dict(zip(live, range(len(live))))
+        order = self.sampler.order()
+        self._names = [self._names[index] for index in live]
+        self._counts = array("q", [self._counts[index] for index in live])
+        self._rehash(len(live))
+        self.sampler.clear()
+        for index in range(len(live)):
+            self.sampler.add(index)
+        for index in order:
+            self.sampler.touch(renumbered[index])
+
+    @classmethod
+    def from_state(cls, names, selection_counts, selection_order, token=None, version=0):
+        selector = cls(token=token, version=version)
+        selector.add_names(names)
+        for name, count in selection_counts.items():
+            selector._counts[selector._index(name)] = count
+        for name in selection_order:
+            selector.sampler.touch(selector._index(name))
+        return selector
+
+def new_token():
+    return os.urandom(4).hex()
+
+# Stands in for a class spilled out of memory, keeping its place in the registry
+class _Cold:
+    __slots__ = ("size",)
+
+    def __init__(self, size):
+        self.size = size  # Names the class held when it was spilled
+
+# Long-lived selectors, one per class, kept in creation order.
+# Every mutation goes through apply() and is appended to the storage log,
+# holding the storage's lock for that class, then published to the hub.
+class ClassRegistry:
+    def __init__(self, storage=None, hub=None, max_resident_names=None):
+        self._selectors = {}  # class -> NameSelector, or _Cold once spilled
+        self.storage = storage if storage is not None else NullStorage()
+        self.hub = hub if hub is not None else EventHub()
+        # Least recently used classes are spilled once the resident classes
+        # hold more names than this; each class also counts one for itself, and
+        # its cached payloads as names (see NameSelector.footprint)
+        self.max_resident_names = max_resident_names
+        self._lru = OrderedDict()  # Resident class -> size, least recently used first
+        self._resident_names = 0
+        self._lru_lock = threading.Lock()
+
+    def __contains__(self, class_name):
+        return class_name in self._selectors
+
+    def __len__(self):
+        return len(self._selectors)
+
+    def get(self, class_name):
+        if class_name is None:
+            return None
+        selector = self._get(class_name)
+        self.evict()
+        return selector
+
+    def keys(self):
+        self.storage.refresh_classes(self)
+        return list(self._selectors)
+
+    def items(self):
+        # Spilled classes are read back for the caller without becoming resident
+        for class_name, selector in list(self._selectors.items()):
+            if isinstance(selector, _Cold):
+                selector = NameSelector.from_state(*self.storage.cold_state(class_name))
+            yield class_name, selector
+
+    def copy(self, class_name):
+        # Names and counts of one class, read without making a spilled class
+        # resident; None if there is no such class
+        with self.storage.lock(class_name):
+            if not isinstance(self._selectors.get(class_name), _Cold):
+                self.storage.refresh(self, class_name)
+            selector = self._selectors.get(class_name)
+            if selector is None:
+                return None
+            if isinstance(selector, _Cold):
+                return self.storage.cold_state(class_name)[:2]
+            return selector.names, selector.selection_counts
+
+    def copy_states(self):
+        # Copies every class for a snapshot as restore() arguments; spilled
+        # classes stay on disk and are returned as None. Callers hold the
+        # storage's lock.
+        return [
+            (class_name, None if isinstance(selector, _Cold) else (
+                selector.names, selector.selection_counts, selector.selection_order,
+                selector.token, selector.version,
+            ))
+            for class_name, selector in self._selectors.items()
+        ]
+
+    def total_names(self):
+        return sum(
+            selector.size if isinstance(selector, _Cold) else len(selector)
+            for selector in list(self._selectors.values())
+        )
+
+    def resident_names(self):
+        return sum(len(selector) for selector in list(self._selectors.values()) if isinstance(selector, NameSelector))
+
+    def create(self, class_name):
+        if not class_name:
+            return None
+        with self.storage.registry_lock(), self.storage.lock(class_name):
+            self.storage.refresh_classes(self)
+            if class_name in self._selectors:
+                return None
+            return self._commit("create_class", class_name, new_token())
+
+    def delete(self, class_name):
+        with self.storage.registry_lock(), self.storage.lock(class_name):
+            self.storage.refresh_classes(self)
+            if class_name not in self._selectors:
+                return None
+            return self._commit("delete_class", class_name)
+
+    def rename(self, old_name, new_name):
+        if not old_name or not new_name:
+            return False
+        storage = self.storage
+        with storage.registry_lock(), storage.lock(old_name), storage.lock(new_name):
+            storage.refresh_classes(self)
+            if old_name not in self._selectors or new_name in self._selectors:
+                return False
+            self._commit("edit_class", old_name, new_name)
+            return True
+
+    # Eviction takes other classes' locks, so it runs after the class lock is released
+    def add_name(self, class_name, name):
+        if class_name is None:
+            return None
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None and name and name not in selector:
+                self._commit("add_name", class_name, name)
+        self.evict()
+        return selector
+
+    def add_names(self, class_name, names):
+        # Adds a batch of names as one logged operation, returns how many were new
+        if class_name is None:
+            return None, 0
+        new_names = []
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None:
+                new_names = [name for name in dict.fromkeys(names) if name and name not in selector]
+                if new_names:
+                    self._commit("add_names", class_name, new_names)
+        self.evict()
+        return selector, len(new_names)
+
+    def delete_name(self, class_name, name):
+        if class_name is None:
+            return None
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None and name in selector:
+                self._commit("delete_name", class_name, name)
+        self.evict()
+        return selector
+
+    def select_name(self, class_name):
+        if class_name is None:
+            return None, None, "Class not found"
+        selected_name, error = None, "Class not found"
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None:
+                selected_name, error = selector.draw_name()
+                if error is None:
+                    self._commit("select_name", class_name, selected_name)
+        self.evict()
+        return selector, selected_name, error
+
+    def select_names(self, class_name, k, replace=False):
+        if class_name is None:
+            return None, None, "Class not found"
+        selected_names, error = None, "Class not found"
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None:
+                selected_names, error = selector.draw_names(k, replace)
+                if error is None:
+                    self._commit("select_names", class_name, selected_names)
+        self.evict()
+        return selector, selected_names, error
+
+    def simulate(self, class_name, draws):
+        if class_name is None:
+            return None, "Class not found"
+        result = None, "Class not found"
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None:
+                result = selector.simulate(draws)
+        self.evict()
+        return result
+
+    def reset(self, class_name):
+        if class_name is None:
+            return None
+        with self.storage.lock(class_name):
+            selector = self._get(class_name)
+            if selector is not None:
+                self._commit("reset", class_name)
+        self.evict()
+        return selector
+
+    # Cache maintenance for storage engines, not logged
+    def restore(self, class_name, names, selection_counts, selection_order, token=None, version=0):
+        selector = NameSelector.from_state(names, selection_counts, selection_order, token, version)
+        self._selectors[class_name] = selector
+        self._account(class_name, selector)
+
+    def unload(self, class_name):
+        self._selectors.pop(class_name, None)
+        self._account(class_name, None)
+
+    def park(self, class_name, size):
+        self._selectors[class_name] = _Cold(size)
+        self._account(class_name, None)
+
+    def evict(self):
+        # Spills least recently used classes until the rest fit the cap. The
+        # most recently used class always stays, however large it is.
+        while self.max_resident_names is not None:
+            with self._lru_lock:
+                if self._resident_names <= self.max_resident_names or len(self._lru) <= 1:
+                    return
+                class_name = next(iter(self._lru))
+            with self.storage.lock(class_name):
+                with self._lru_lock:
+                    if next(iter(self._lru), None) != class_name:
+                        continue  # Used again while we waited for its lock
+                    self._resident_names -= self._lru.pop(class_name)
+                selector = self._selectors.get(class_name)
+                if isinstance(selector, NameSelector):
+                    self.storage.spill(self, class_name, selector)
+
+    def reorder(self, class_names):
+        self._selectors = {name: self._selectors[name] for name in class_names if name in self._selectors}
+
+    def apply(self, op, class_name, arg=None):
+        # Applies one logged mutation; also used to replay the log on startup
+        if op == "create_class":
+            selector = self._selectors[class_name] = NameSelector(token=arg)
+            self._account(class_name, selector)
+            return selector
+        selector = self._resident(class_name)
+        if op == "delete_class":
+            self._account(class_name, None)
+            return self._selectors.pop(class_name)
+        if op == "edit_class":
+            self._account(class_name, None)
+            self._selectors[arg] = self._selectors.pop(class_name)
+            self._account(arg, selector)
+            return selector
+        if op == "add_name":
+            selector.add_name(arg)
+        elif op == "add_names":
+            selector.add_names(arg)
+        elif op == "delete_name":
+            selector.delete_name(arg)
+        elif op == "select_name":
+            selector.mark_selected(arg)
+        elif op == "select_names":
+            for name in arg:
+                selector.mark_selected(name)
+        elif op == "reset":
+            selector.reset()
+        else:
+            raise ValueError("Unknown operation: %s" % op)
+        selector.record_change(arg if isinstance(arg, list) else [arg] if arg else [])
+        self._account(class_name, selector)
+        return selector
+
+    def _get(self, class_name):
+        self.storage.refresh(self, class_name)
+        selector = self._selectors.get(class_name)
+        if isinstance(selector, _Cold):
+            with self.storage.lock(class_name):
+                selector = self._resident(class_name) if class_name in self._selectors else None
+        if selector is not None:
+            self._account(class_name, selector)
+        return selector
+
+    def _resident(self, class_name):
+        # Reads a spilled class back into memory; callers hold its lock
+        selector = self._selectors[class_name]
+        if isinstance(selector, _Cold):
+            self.storage.fill(self, class_name)
+            selector = self._selectors.get(class_name)
+        return selector
+
+    def _account(self, class_name, selector):
+        # Moves a resident class to the most recently used end, or drops it
+        if self.max_resident_names is None:
+            return
+        with self._lru_lock:
+            self._resident_names -= self._lru.pop(class_name, 0)
+            if selector is not None:
+                size = self._lru[class_name] = selector.footprint()
+                self._resident_names += size
+
+    def _commit(self, op, class_name, arg=None):
+        # Storage first: if the write fails, memory still matches what was stored
+        self.storage.append(op, class_name, arg)
+        result = self.apply(op, class_name, arg)
+        if op == "delete_class":
+            self.hub.close(class_name)
+        elif op == "edit_class":
+            self.hub.rename(class_name, arg)
+        elif self.hub.has_subscribers(class_name):
+            self.hub.publish(class_name, op, event_data(op, arg, result))
+        return result
+
+# Compact SSE payloads; clients fetch anything larger from /class_state
+def event_data(op, arg, selector):
+    data = {"version": selector.version}
+    if op == "select_name":
+        data["selected"], data["count"] = arg, selector.count(arg)
+    elif op == "select_names":
+        data["selected"], data["counts"] = arg, {name: selector.count(name) for name in arg}
+    elif op == "add_name" or op == "delete_name":
+        data["names"] = [arg]
+    elif op == "add_names":
+        data["added"] = len(arg)
+    return data
+
+# Store class names and corresponding selectors. State is kept in
+# NAME_SELECTOR_DATA_DIR (the instance folder by default). NAME_SELECTOR_STORAGE
+# picks the engine: "log" (default, one process), "shared" for several worker
+# processes, e.g. `NAME_SELECTOR_STORAGE=shared gunicorn -w 4 app:app`, or
+# "memory" to keep state in memory only. NAME_SELECTOR_MAX_RESIDENT_NAMES caps
+# the names kept in memory; classes beyond it are spilled to disk, least
+# recently used first, and read back when they are next used.
+def make_storage():
+    engine = os.environ.get("NAME_SELECTOR_STORAGE", "log")
+    data_dir = os.environ.get("NAME_SELECTOR_DATA_DIR", app.instance_path)
+    if engine == "memory":
+        return NullStorage()
+    if engine == "shared":
+        return SharedStorage(data_dir)
+    return LogStorage(data_dir)
+
+def max_resident_names():
+    value = os.environ.get("NAME_SELECTOR_MAX_RESIDENT_NAMES")
+    return int(value) if value else None
+
+classes = ClassRegistry(make_storage(), max_resident_names=max_resident_names())
+if not classes.storage.load(classes):
+    classes.create("Class 1")
+atexit.register(classes.storage.close)
+
+# Request metrics, served at /metrics. Setting NAME_SELECTOR_PROFILE_SLOW_MS
+# profiles a sample (NAME_SELECTOR_PROFILE_RATE, default 5%) of requests and
+# dumps those slower than the threshold into the profiles/ folder.
+def make_profiler():
+    threshold = os.environ.get("NAME_SELECTOR_PROFILE_SLOW_MS")
+    if not threshold:
+        return None
+    return SlowRequestProfiler(
+        float(threshold) / 1000.0,
+        float(os.environ.get("NAME_SELECTOR_PROFILE_RATE", "0.05")),
+        os.path.join(os.environ.get("NAME_SELECTOR_DATA_DIR", app.instance_path), "profiles"),
+    )
+
+metrics = Metrics(make_profiler())
+
+@app.before_request
+def start_request_timer():
+    metrics.request_started()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    metrics.request_finished(
+        route, response.status_code, request.content_length, response.content_length,
+        g.get("request_failed", False),
+    )
+    return response
+
+# Failed requests still answer 200 with "success": false, so they are flagged
+# here and counted apart from 5xx responses
+def failure(error):
+    g.request_failed = True
+    return jsonify({"success": False, "error": error})
 
 # Routes
 @app.route("/")
 def index():
-    class_names = list(classes.keys())
+    class_names = classes.keys()
     return render_template("index.html", class_names=class_names)
 
 @app.route("/create_class", methods=["POST"])
 def create_class():
     class_name = request.form.get("class_name")
-    if class_name and class_name not in classes:
-        classes[class_name] = {"names": [], "selection_counts": {}}
-        return jsonify({"success": True, "class_names": list(classes.keys())})
-    return jsonify({"success": False, "error": "Class already exists or invalid name"})
+    if classes.create(class_name) is not None:
+        return jsonify({"success": True, "class_names": classes.keys()})
+    return failure("Class already exists or invalid name")
 
 @app.route("/delete_class", methods=["POST"])
 def delete_class():
     class_name = request.form.get("class_name")
-    if class_name in classes:
-        del classes[class_name]
-        return jsonify({"success": True, "class_names": list(classes.keys())})
-    return jsonify({"success": False, "error": "Class not found"})
+    if classes.delete(class_name) is not None:
+        return jsonify({"success": True, "class_names": classes.keys()})
+    return failure("Class not found")
 
+# Selectors are read under the class lock so a concurrent mutation can't
+# change them mid-copy
 @app.route("/get_counts", methods=["GET"])
 def get_counts():
     class_name = request.args.get("class_name")
-    names, counts = get_class_data(class_name)
-    return jsonify(counts)
+    selector = classes.get(class_name)
+    if selector is None:
+        return jsonify({})
+    with classes.storage.lock(class_name):
+        return jsonify(selector.selection_counts)
 
 @app.route("/get_names", methods=["GET"])
 def get_names():
     class_name = request.args.get("class_name")
-    names, _ = get_class_data(class_name)
-    return jsonify(names)
+    selector = classes.get(class_name)
+    if selector is None:
+        return jsonify([])
+    with classes.storage.lock(class_name):
+        return jsonify(selector.names)
+
+# Names and counts in one response. Clients holding an earlier version of the
+# same class (`token`) can pass `since` to get only what changed after it.
+@app.route("/class_state", methods=["GET"])
+def class_state():
+    class_name = request.args.get("class_name")
+    selector = classes.get(class_name)
+    if selector is None:
+        return failure("Class not found")
+    since = request.args.get("since", type=int)
+    # Read once: a mutation may bump the version while this request runs
+    token, version = selector.token, selector.version
+    if request.args.get("token", token) != token:
+        since = None
+
+    cached = selector.cached_state(since)
+    if cached is None and request.if_none_match.contains("%s-%d" % (token, version)):
+        cached = (version, None)
+    if cached is None:
+        with classes.storage.lock(class_name):
+            cached = selector.state_payload(since)
+    version, payload = cached
+    etag = "%s-%d" % (token, version)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(payload, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+# Live updates for one class as Server-Sent Events
+@app.route("/events", methods=["GET"])
+def events():
+    class_name = request.args.get("class_name")
+    selector = classes.get(class_name)
+    if selector is None:
+        return failure("Class not found")
+    subscriber = classes.hub.subscribe(class_name)
+    hello = encode_event("hello", {"token": selector.token, "version": selector.version})
+    return Response(
+        classes.hub.stream(subscriber, hello),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.route("/add_name", methods=["POST"])
 def add_name():
     class_name = request.form.get("class_name")
-    name = request.form.get("name")
-    if class_name in classes:
-        selector = NameSelector()
-        selector.names, selector.selection_counts = classes[class_name]["names"], classes[class_name]["selection_counts"]
-        selector.add_name(name)
-        classes[class_name]["names"] = selector.names
-        classes[class_name]["selection_counts"] = selector.selection_counts
-        return jsonify({"success": True, "names": selector.names})
-    return jsonify({"success": False, "error": "Class not found"})
+    selector = classes.add_name(class_name, request.form.get("name"))
+    if selector is not None:
+        with classes.storage.lock(class_name):
+            return jsonify({"success": True, "names": selector.names})
+    return failure("Class not found")
 
 @app.route("/delete_name", methods=["POST"])
 def delete_name():
     class_name = request.form.get("class_name")
-    name = request.form.get("name")
-    if class_name in classes:
-        selector = NameSelector()
-        selector.names, selector.selection_counts = classes[class_name]["names"], classes[class_name]["selection_counts"]
-        selector.delete_name(name)
-        classes[class_name]["names"] = selector.names
-        classes[class_name]["selection_counts"] = selector.selection_counts
-        return jsonify({"success": True, "names": selector.names})
-    return jsonify({"success": False, "error": "Class not found"})
+    selector = classes.delete_name(class_name, request.form.get("name"))
+    if selector is not None:
+        with classes.storage.lock(class_name):
+            return jsonify({"success": True, "names": selector.names})
+    return failure("Class not found")
 
 @app.route("/select_name", methods=["POST"])
 def select_name():
+    started = time.perf_counter()
     class_name = request.form.get("class_name")
-    if class_name in classes:
-        selector = NameSelector()
-        selector.names, selector.selection_counts = classes[class_name]["names"], classes[class_name]["selection_counts"]
-        selected_name, error = selector.select_name()
-        if error:
-            return jsonify({"success": False, "error": error})
+    selector, selected_name, error = classes.select_name(class_name)
+    metrics.selections.observe("select_name", time.perf_counter() - started)
+    if error:
+        return failure(error)
+    with classes.storage.lock(class_name):
         return jsonify({"success": True, "selected_name": selected_name, "counts": selector.selection_counts})
-    return jsonify({"success": False, "error": "Class not found"})
+
+MAX_SIMULATED_DRAWS = 1000000
+MAX_SELECTED_NAMES = 10000  # Selections are logged, so keep one request's batch small
+
+# Draws k names in one request, or previews hits over `simulate` draws
+@app.route("/select_names", methods=["POST"])
+def select_names():
+    class_name = request.form.get("class_name")
+    try:
+        k = int(request.form.get("k", 1))
+        draws = int(request.form.get("simulate", 0))
+    except ValueError:
+        return failure("Invalid number of draws")
+    if draws < 0:
+        return failure("Invalid number of draws")
+    if draws > MAX_SIMULATED_DRAWS:
+        return failure("At most %d draws can be simulated" % MAX_SIMULATED_DRAWS)
+    if k > MAX_SELECTED_NAMES:
+        return failure("At most %d names can be selected at once" % MAX_SELECTED_NAMES)
+    started = time.perf_counter()
+    if draws > 0:
+        hits, error = classes.simulate(class_name, draws)
+        metrics.selections.observe("simulate", time.perf_counter() - started)
+        if error:
+            return failure(error)
+        return jsonify({"success": True, "simulated": draws, "hits": hits})
+    replace = request.form.get("replace", "false").lower() in ("1", "true", "yes")
+    selector, selected_names, error = classes.select_names(class_name, k, replace)
+    metrics.selections.observe("select_names", time.perf_counter() - started)
+    if error:
+        return failure(error)
+    with classes.storage.lock(class_name):
+        return jsonify({"success": True, "selected_names": selected_names, "counts": selector.selection_counts})
 
 @app.route("/reset", methods=["POST"])
 def reset():
-    class_name = request.form.get("class_name")
-    if class_name in classes:
-        classes[class_name]["names"] = []
-        classes[class_name]["selection_counts"] = {}
+    if classes.reset(request.form.get("class_name")) is not None:
         return jsonify({"success": True})
-    return jsonify({"success": False, "error": "Class not found"})
+    return failure("Class not found")
+
+@app.route("/import_roster", methods=["POST"])
+def import_roster():
+    class_name = request.values.get("class_name")
+    upload = request.files.get("file")
+    if upload is not None:
+        stream, fmt = upload.stream, roster.guess_format(upload.filename, upload.mimetype)
+    else:
+        stream, fmt = request.stream, roster.guess_format(None, request.mimetype)
+    fmt = request.values.get("format", fmt)
+
+    # Group names per class, using dicts as ordered hash sets to drop repeats
+    batches = {}
+    try:
+        for row_class, name in roster.parse_roster(stream, fmt):
+            if name:
+                batches.setdefault(row_class or class_name, {})[name] = None
+    except (ValueError, UnicodeDecodeError, csv.Error):
+        return failure("Could not parse roster")
+    if None in batches or (class_name in batches and classes.get(class_name) is None):
+        return failure("Class not found")
+
+    added = {}
+    for target, names in batches.items():
+        if target != class_name:
+            classes.create(target)  # Classes named in the file are created on demand
+        selector, count = classes.add_names(target, names)
+        if selector is None:
+            return failure("Class not found")
+        added[target] = count
+    return jsonify({"success": True, "added": added, "class_names": classes.keys()})
+
+@app.route("/export_roster", methods=["GET"])
+def export_roster():
+    class_name = request.args.get("class_name")
+    fmt = request.args.get("format", "csv")
+    if fmt not in roster.FORMATS:
+        return failure("Unknown format")
+    class_names = classes.keys()
+    if class_name:
+        if class_name not in class_names:
+            return failure("Class not found")
+        class_names = [class_name]
+
+    # Copies each class when its turn comes, straight from disk if it was
+    # spilled, so an export doesn't cycle cold classes through memory; rows
+    # are encoded in chunks
+    def items():
+        for target in class_names:
+            state = classes.copy(target)
+            if state is not None:
+                names, counts = state
+                yield target, names, counts
+
+    return Response(
+        roster.export_roster(items(), fmt),
+        mimetype=roster.FORMATS[fmt],
+        headers={"Content-Disposition": "attachment; filename=roster.%s" % fmt},
+    )
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    gauges = {
+        "name_selector_classes": ("Classes in the registry.", len(classes)),
+        "name_selector_names": ("Names held across all classes.", classes.total_names()),
+        "name_selector_resident_names": ("Names held by classes kept in memory.", classes.resident_names()),
+        "name_selector_event_subscribers": ("Open /events streams.", len(classes.hub)),
+    }
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 @app.route("/edit_class", methods=["POST"])
 def edit_class():
     old_name = request.form.get("old_name")
     new_name = request.form.get("new_name")
-    if old_name in classes and new_name and new_name not in classes:
-        classes[new_name] = classes.pop(old_name)
-        return jsonify({"success": True, "class_names": list(classes.keys())})
-    return jsonify({"success": False, "error": "Invalid class names"})
+    if classes.rename(old_name, new_name):
+        return jsonify({"success": True, "class_names": classes.keys()})
+    return failure("Invalid class names")
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5000)
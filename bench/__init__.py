@@ -0,0 +1,16 @@
+'''
+Benchmarks for the name selector
+
+    python -m bench micro      selector add/delete/select across roster sizes
+    python -m bench load       every route at a configurable concurrency
+    python -m bench fairness   optimized samplers against the reference weights
+    python -m bench workers    shared storage throughput as workers are added
+
+Every benchmark prints a JSON report (or writes it with --output) so runs can
+be compared with each other.
+'''
+
+import os
+
+# Benchmarks never touch the instance folder unless asked to
+os.environ.setdefault("NAME_SELECTOR_STORAGE", "memory")
@@ -0,0 +1,9 @@
+import sys
+
+from bench import fairness, load, micro, workers
+
+COMMANDS = {"micro": micro, "load": load, "fairness": fairness, "workers": workers}
+
+if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+    sys.exit("usage: python -m bench {%s} [options]" % ",".join(COMMANDS))
+COMMANDS[sys.argv[1]].main(sys.argv[2:])
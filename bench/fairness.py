@@ -0,0 +1,102 @@
+'''
+Statistical fairness check for the optimized sampling paths
+
+Builds a roster with a seeded mix of selected and never-selected names, takes
+the exact recency weights from the reference LinearSampler, and runs a
+chi-square goodness-of-fit test on draws from FenwickSampler and from the
+vectorized NameSelector.draw_names path. Exits non-zero if any path is
+rejected at --alpha.
+
+    python -m bench.fairness --names 50 --draws 200000 --seed 0
+'''
+
+import argparse
+import math
+import random
+import sys
+
+import numpy as np
+
+from bench.stats import environment, write_report
+from app import NameSelector
+from sampler import FenwickSampler, LinearSampler
+
+
+def chi_square_p_value(statistic, dof):
+    # Wilson-Hilferty approximation of the chi-square upper tail
+    if dof <= 0:
+        return 1.0
+    scale = 2.0 / (9.0 * dof)
+    z = ((statistic / dof) ** (1.0 / 3.0) - (1.0 - scale)) / math.sqrt(scale)
+    return 0.5 * math.erfc(z / math.sqrt(2.0))
+
+
+def goodness_of_fit(observed, expected):
+    statistic = float(((observed - expected) ** 2 / expected).sum())
+    dof = len(observed) - 1
+    return {"statistic": statistic, "dof": dof, "p_value": chi_square_p_value(statistic, dof)}
+
+
+def prepare(names, touches, seed):
+    # The same history applied to the reference and the optimized engines
+    rng = random.Random(seed)
+    reference, fenwick, selector = LinearSampler(), FenwickSampler(), NameSelector()
+    # The samplers know names by index, as inside NameSelector
+    roster = ["Student %d" % i for i in range(names)]
+    for index, name in enumerate(roster):
+        reference.add(index)
+        fenwick.add(index)
+        selector.add_name(name)
+    for _ in range(touches):
+        index = rng.randrange(names * 3 // 4)  # Leave some names never selected
+        reference.touch(index)
+        fenwick.touch(index)
+        selector.mark_selected(roster[index])
+    return roster, reference, fenwick, selector
+
+
+def run(names, touches, draws, seed, alpha):
+    roster, reference, fenwick, selector = prepare(names, touches, seed)
+    order, weights = reference.weights()
+    index = {roster[name_index]: i for i, name_index in enumerate(order)}
+    expected = weights / weights.sum() * draws
+
+    rng = random.Random(seed + 1)
+    observed = np.zeros(len(order))
+    for _ in range(draws):
+        observed[index[roster[fenwick.draw(rng)]]] += 1
+    checks = {"fenwick_draw": goodness_of_fit(observed, expected)}
+
+    picks, _ = selector.draw_names(draws, replace=True, rng=np.random.default_rng(seed + 2))
+    observed = np.zeros(len(order))
+    for name in picks:
+        observed[index[name]] += 1
+    checks["vectorized_draw_names"] = goodness_of_fit(observed, expected)
+
+    for check in checks.values():
+        check["passed"] = check["p_value"] >= alpha
+    return {
+        "benchmark": "fairness",
+        "environment": environment(names=names, touches=touches, draws=draws, seed=seed, alpha=alpha),
+        "passed": all(check["passed"] for check in checks.values()),
+        "checks": checks,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--names", type=int, default=50)
+    parser.add_argument("--touches", type=int, default=200, help="selections applied before testing")
+    parser.add_argument("--draws", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alpha", type=float, default=0.001)
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+    report = run(args.names, args.touches, args.draws, args.seed, args.alpha)
+    write_report(report, args.output)
+    if not report["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+'''
+Load generator that drives every route of the app
+
+By default requests go through the Flask test client in this process; pass
+--url to drive a running server instead. Each of the --concurrency threads
+works on its own class, seeded from --seed, and runs a weighted mix of
+routes. The report has per-route p50/p95/p99 latency, overall throughput and
+peak memory.
+
+    python -m bench.load --concurrency 8 --requests 2000 --names 500
+    python -m bench.load --url http://127.0.0.1:5000 --concurrency 32
+'''
+
+import argparse
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from bench.stats import environment, peak_rss_bytes, percentiles, write_report
+
+# (route, method, weight) for the steady-state mix; mutating class-level
+# routes run once per thread at setup and teardown
+MIX = [
+    ("/select_name", "POST", 30),
+    ("/class_state", "GET", 20),
+    ("/get_names", "GET", 8),
+    ("/get_counts", "GET", 8),
+    ("/add_name", "POST", 8),
+    ("/delete_name", "POST", 6),
+    ("/select_names", "POST", 6),
+    ("/export_roster", "GET", 3),
+    ("/import_roster", "POST", 2),
+    ("/", "GET", 2),
+    ("/metrics", "GET", 1),
+    ("/events", "GET", 1),
+    ("/reset", "POST", 1),
+]
+
+
+class TestClient:
+    def __init__(self):
+        from app import app
+
+        self._client = app.test_client()
+
+    def request(self, method, path, data=None, body=None, content_type=None):
+        if path == "/events":
+            # Read the greeting event and hang up, like a display reconnecting
+            response = self._client.get(path, query_string=data, buffered=False)
+            next(iter(response.response))
+            response.close()
+            return response.status_code, 0
+        if method == "GET":
+            response = self._client.get(path, query_string=data)
+        elif body is not None:
+            response = self._client.post(path, query_string=data, data=body, content_type=content_type)
+        else:
+            response = self._client.post(path, data=data)
+        return response.status_code, len(response.get_data())
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, path, data=None, body=None, content_type=None):
+        query = urllib.parse.urlencode(data or {})
+        if method == "GET" or body is not None:
+            url, payload = "%s%s?%s" % (self.base_url, path, query), body
+        else:
+            url, payload = self.base_url + path, query.encode()
+            content_type = "application/x-www-form-urlencoded"
+        request = urllib.request.Request(url, data=payload, method=method)
+        if content_type:
+            request.add_header("Content-Type", content_type)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                size = len(response.readline() if path == "/events" else response.read())
+                return response.status, size
+        except urllib.error.HTTPError as error:
+            return error.code, 0
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, client, requests, names, seed, latencies):
+        super().__init__(daemon=True)
+        self.client = client
+        self.requests = requests
+        self.names = names
+        self.rng = random.Random(seed + index)
+        self.class_name = "Load %d-%d" % (seed, index)
+        self.latencies = latencies  # route -> list of nanoseconds, owned by this thread
+        self.errors = 0
+        self.bytes = 0
+
+    def call(self, route, method, data=None, body=None, content_type=None):
+        begin = time.perf_counter_ns()
+        status, size = self.client.request(method, route, data, body, content_type)
+        self.latencies.setdefault(route, []).append(time.perf_counter_ns() - begin)
+        self.bytes += size
+        if status >= 400:
+            self.errors += 1
+
+    def roster(self, count):
+        return ("\n".join("Student %d" % self.rng.randrange(self.names * 2) for _ in range(count))).encode()
+
+    def run(self):
+        cls = {"class_name": self.class_name}
+        self.call("/create_class", "POST", cls)
+        self.call("/import_roster", "POST", cls, self.roster(self.names), "text/csv")
+        routes = [entry[:2] for entry in MIX]
+        weights = [entry[2] for entry in MIX]
+        for route, method in self.rng.choices(routes, weights=weights, k=self.requests):
+            if route in ("/add_name", "/delete_name"):
+                data = dict(cls, name="Student %d" % self.rng.randrange(self.names * 2))
+                self.call(route, method, data)
+            elif route == "/select_names":
+                self.call(route, method, dict(cls, k=5))
+            elif route == "/import_roster":
+                self.call(route, method, cls, self.roster(50), "text/csv")
+            elif route in ("/", "/metrics"):
+                self.call(route, method)
+            else:
+                self.call(route, method, cls)
+        self.call("/edit_class", "POST", {"old_name": self.class_name, "new_name": self.class_name + " done"})
+        self.call("/delete_class", "POST", {"class_name": self.class_name + " done"})
+
+
+def run(concurrency, requests, names, seed, url=None):
+    workers = [
+        Worker(i, HttpClient(url) if url else TestClient(), requests, names, seed, {})
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    merged = {}
+    for worker in workers:
+        for route, samples in worker.latencies.items():
+            merged.setdefault(route, []).extend(samples)
+    total = sum(len(samples) for samples in merged.values())
+    return {
+        "benchmark": "load",
+        "environment": environment(
+            concurrency=concurrency, requests=requests, names=names, seed=seed, target=url or "test-client"
+        ),
+        "elapsed_seconds": elapsed,
+        "requests": total,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "errors": sum(worker.errors for worker in workers),
+        "response_bytes": sum(worker.bytes for worker in workers),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "overall": percentiles([sample for samples in merged.values() for sample in samples]),
+        "routes": {route: percentiles(samples) for route, samples in sorted(merged.items())},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per thread")
+    parser.add_argument("--names", type=int, default=200, help="roster size per class")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="drive a running server instead of the test client")
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+    write_report(run(args.concurrency, args.requests, args.names, args.seed, args.url), args.output)
+
+
+if __name__ == "__main__":
+    main()
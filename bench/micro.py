@@ -0,0 +1,100 @@
+'''
+Micro-benchmarks of NameSelector add, delete and select across roster sizes
+
+    python -m bench.micro --sizes 10 1000 100000 1000000 --ops 2000 --seed 0
+'''
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from bench.stats import environment, peak_rss_bytes, percentiles, write_report
+from app import NameSelector
+from sampler import FenwickSampler, LinearSampler
+
+SAMPLERS = {"fenwick": FenwickSampler, "linear": LinearSampler}
+
+
+def build(size, sampler):
+    selector = NameSelector(SAMPLERS[sampler]())
+    selector.add_names("Student %d" % i for i in range(size))
+    return selector
+
+
+def bench_size(size, ops, seed, sampler):
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    selector = build(size, sampler)
+    build_seconds = time.perf_counter() - start
+
+    # Warm the recency state so draws see a mix of selected and fresh names
+    for _ in range(min(size, ops)):
+        selector.select_name(rng)
+
+    timings = {"select": [], "add": [], "delete": []}
+    clock = time.perf_counter_ns
+    for _ in range(ops):
+        begin = clock()
+        selector.select_name(rng)
+        timings["select"].append(clock() - begin)
+    new_names = ["New %d" % i for i in range(ops)]
+    for name in new_names:
+        begin = clock()
+        selector.add_name(name)
+        timings["add"].append(clock() - begin)
+    rng.shuffle(new_names)
+    for name in new_names:
+        begin = clock()
+        selector.delete_name(name)
+        timings["delete"].append(clock() - begin)
+
+    result = {"size": size, "build_seconds": build_seconds}
+    for op, samples in timings.items():
+        summary = percentiles(samples)
+        summary["ops_per_second"] = len(samples) / (sum(samples) / 1e9) if samples else 0.0
+        result[op] = summary
+    return result
+
+
+def traced_peak(size, sampler):
+    # Measured in a separate pass so tracing does not skew the timings
+    tracemalloc.start()
+    selector = build(size, sampler)
+    selector.select_name(random.Random(0))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def run(sizes, ops, seed, sampler, memory=True):
+    results = []
+    for size in sizes:
+        # The reference sampler is O(n) per draw; keep its runs short
+        size_ops = ops if sampler != "linear" else max(1, min(ops, 2000000 // max(size, 1)))
+        result = bench_size(size, size_ops, seed, sampler)
+        if memory:
+            result["peak_traced_bytes"] = traced_peak(size, sampler)
+        results.append(result)
+    return {
+        "benchmark": "micro",
+        "environment": environment(sizes=sizes, ops=ops, seed=seed, sampler=sampler),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000, 1000000])
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sampler", choices=sorted(SAMPLERS), default="fenwick")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc pass")
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+    write_report(run(args.sizes, args.ops, args.seed, args.sampler, args.memory), args.output)
+
+
+if __name__ == "__main__":
+    main()
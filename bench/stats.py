@@ -0,0 +1,53 @@
+'''
+Shared helpers for benchmark reports
+'''
+
+import datetime
+import json
+import platform
+import resource
+import sys
+
+
+def percentiles(samples):
+    # Latency summary in microseconds for samples given in nanoseconds
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+
+    def at(fraction):
+        return ordered[min(last, int(round(fraction * last)))] / 1000.0
+
+    return {
+        "count": len(ordered),
+        "mean_us": sum(ordered) / len(ordered) / 1000.0,
+        "p50_us": at(0.50),
+        "p95_us": at(0.95),
+        "p99_us": at(0.99),
+        "max_us": ordered[-1] / 1000.0,
+    }
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def environment(**settings):
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+    }
+
+
+def write_report(report, output=None):
+    text = json.dumps(report, indent=2) + "\n"
+    if output:
+        with open(output, "w") as handle:
+            handle.write(text)
+    else:
+        sys.stdout.write(text)
@@ -0,0 +1,96 @@
+'''
+Throughput of the shared storage engine as worker processes are added
+
+Each worker imports the app with NAME_SELECTOR_STORAGE=shared against one
+data directory and drives /select_name through the Flask test client, the
+way several gunicorn workers would share a deployment. Workers pick classes
+at random, so selections in different classes run side by side.
+
+    python -m bench.workers --workers 1 2 4 8 --duration 5
+'''
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from bench.stats import environment, write_report
+
+
+def _setup(data_dir, classes, names):
+    os.environ["NAME_SELECTOR_STORAGE"] = "shared"
+    os.environ["NAME_SELECTOR_DATA_DIR"] = data_dir
+    from app import app
+
+    client = app.test_client()
+    for i in range(classes):
+        class_name = "Class %d" % i
+        client.post("/create_class", data={"class_name": class_name})
+        for j in range(names):
+            client.post("/add_name", data={"class_name": class_name, "name": "Student %d" % j})
+
+
+def _worker(data_dir, classes, seed, start, duration, results):
+    os.environ["NAME_SELECTOR_STORAGE"] = "shared"
+    os.environ["NAME_SELECTOR_DATA_DIR"] = data_dir
+    from app import app
+
+    client = app.test_client()
+    rng = random.Random(seed)
+    class_names = ["Class %d" % i for i in range(classes)]
+    start.wait()
+    requests = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        client.post("/select_name", data={"class_name": rng.choice(class_names)})
+        requests += 1
+    results.put(requests)
+
+
+def run(workers, duration, classes, names, seed):
+    ctx = multiprocessing.get_context("spawn")
+    report = {
+        "benchmark": "workers",
+        "environment": environment(workers=workers, duration=duration, classes=classes, names=names, seed=seed),
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory() as data_dir:
+        setup = ctx.Process(target=_setup, args=(data_dir, classes, names))
+        setup.start()
+        setup.join()
+        for count in workers:
+            start = ctx.Barrier(count + 1)
+            results = ctx.Queue()
+            processes = [
+                ctx.Process(target=_worker, args=(data_dir, classes, seed + i, start, duration, results))
+                for i in range(count)
+            ]
+            for process in processes:
+                process.start()
+            start.wait()
+            total = sum(results.get() for _ in processes)
+            for process in processes:
+                process.join()
+            report["runs"].append({"workers": count, "requests": total, "rps": total / duration})
+    base = report["runs"][0]["rps"] / report["runs"][0]["workers"]
+    for entry in report["runs"]:
+        entry["scaling"] = entry["rps"] / base
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--classes", type=int, default=64)
+    parser.add_argument("--names", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+    write_report(run(args.workers, args.duration, args.classes, args.names, args.seed), args.output)
+
+
+if __name__ == "__main__":
+    main()
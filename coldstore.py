@@ -0,0 +1,89 @@
+'''
+On-disk format for classes spilled out of memory
+
+Each class is one file: a fixed header, the class token, then three int64
+arrays (name offsets, selection counts, recency ranks) and the UTF-8 name
+bytes. Files are read through mmap, so loading a class copies the arrays
+straight into array objects without parsing a row per name.
+
+The files are a cache of state that lives elsewhere (the log, the shared
+database or the running process), so they are written without fsync and
+cleared when the store is opened.
+'''
+
+from array import array
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+
+MAGIC = b"NSC1"
+HEADER = struct.Struct("<4sqqI")  # magic, version, name count, token length
+
+
+class ColdStore:
+    def __init__(self, directory):
+        self.directory = directory
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    def write(self, class_name, selector):
+        names = selector.names
+        encoded = [name.encode() for name in names]
+        offsets = array("q", [0])
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        counts = array("q", map(selector.count, names))
+        recency = {name: rank for rank, name in enumerate(selector.selection_order)}
+        ranks = array("q", (recency.get(name, -1) for name in names))  # -1: never selected
+        token = selector.token.encode()
+
+        path = self._path(class_name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(MAGIC, selector.version, len(names), len(token)))
+            f.write(token)
+            offsets.tofile(f)
+            counts.tofile(f)
+            ranks.tofile(f)
+            f.write(b"".join(encoded))
+        os.replace(path + ".tmp", path)
+
+    def read(self, class_name):
+        return read_state(self._path(class_name))
+
+    def link(self, class_name, path):
+        # Pins the current file of a class; later writes and removals replace
+        # the directory entry, not the linked file
+        os.link(self._path(class_name), path)
+
+    def remove(self, class_name):
+        try:
+            os.remove(self._path(class_name))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _path(self, class_name):
+        return os.path.join(self.directory, hashlib.sha1(class_name.encode()).hexdigest() + ".cls")
+
+
+def read_state(path):
+    # Returns the arguments of ClassRegistry.restore after the class name
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, n, token_length = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a spilled class: %s" % path)
+        pos = HEADER.size
+        token = data[pos:pos + token_length].decode()
+        pos += token_length
+        offsets, counts, ranks = array("q"), array("q"), array("q")
+        for values, size in ((offsets, n + 1), (counts, n), (ranks, n)):
+            values.frombytes(data[pos:pos + 8 * size])
+            pos += 8 * size
+        blob = data[pos:pos + offsets[-1]]
+    names = [blob[offsets[i]:offsets[i + 1]].decode() for i in range(n)]
+    order = sorted((rank, i) for i, rank in enumerate(ranks) if rank >= 0)
+    return names, dict(zip(names, counts)), [names[i] for _, i in order], token, version
@@ -0,0 +1,126 @@
+'''
+Per-class publish/subscribe hub for Server-Sent Events
+
+Each subscriber owns a bounded queue of pre-encoded SSE messages. Publishing
+never blocks: when a slow subscriber's queue is full its backlog is dropped
+and replaced by a single "resync" event, telling the client to reload the
+class state instead of replaying every missed change.
+
+Idle subscribers only hold a queue and a waiting stream. Under a greenlet
+worker (`gunicorn -k gevent app:app`) the waits are cooperative, so one
+process can hold thousands of open streams; the threaded development server
+spends a thread per stream instead. gunicorn and gevent are optional
+deployment dependencies and are not in requirements.txt. The hub is per
+process: with the shared storage engine, events reach the streams of the
+worker that applied the change.
+'''
+
+import json
+import queue
+import threading
+
+RESYNC = b"event: resync\ndata: {}\n\n"
+KEEPALIVE = b": keepalive\n\n"
+
+
+def encode_event(event, data):
+    return ("event: %s\ndata: %s\n\n" % (event, json.dumps(data, separators=(",", ":")))).encode()
+
+
+class Subscriber:
+    def __init__(self, class_name, max_queue):
+        self.class_name = class_name
+        self.queue = queue.Queue(max_queue)
+        self.closed = False
+        self.dropped = 0  # Messages discarded because the client fell behind
+
+    def offer(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self._overflow()
+
+    def _overflow(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                break
+        try:
+            self.queue.put_nowait(RESYNC)
+        except queue.Full:
+            pass
+
+
+class EventHub:
+    def __init__(self, max_queue=64, heartbeat=15.0):
+        self.max_queue = max_queue  # Messages buffered per subscriber
+        self.heartbeat = heartbeat  # Seconds between keepalive comments
+        self._subscribers = {}  # class -> set of Subscriber
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def has_subscribers(self, class_name):
+        return bool(self._subscribers.get(class_name))
+
+    def subscribe(self, class_name):
+        subscriber = Subscriber(class_name, self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(class_name, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.class_name)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.class_name]
+
+    def publish(self, class_name, event, data):
+        subscribers = self._subscribers.get(class_name)
+        if not subscribers:
+            return
+        message = encode_event(event, data)  # Encoded once for every subscriber
+        with self._lock:
+            subscribers = list(subscribers)
+        for subscriber in subscribers:
+            subscriber.offer(message)
+
+    def rename(self, old_name, new_name):
+        with self._lock:
+            subscribers = self._subscribers.pop(old_name, set())
+            for subscriber in subscribers:
+                subscriber.class_name = new_name
+            if subscribers:
+                self._subscribers.setdefault(new_name, set()).update(subscribers)
+        self.publish(new_name, "renamed", {"class_name": new_name})
+
+    def close(self, class_name):
+        self.publish(class_name, "deleted", {"class_name": class_name})
+        with self._lock:
+            subscribers = self._subscribers.pop(class_name, set())
+        for subscriber in subscribers:
+            subscriber.closed = True
+
+    def stream(self, subscriber, first=None):
+        # Yields SSE messages until the client disconnects or the class is deleted
+        try:
+            if first is not None:
+                yield first
+            while True:
+                try:
+                    yield subscriber.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    if subscriber.closed:
+                        return
+                    yield KEEPALIVE
+                    continue
+                if subscriber.closed and subscriber.queue.empty():
+                    return
+        finally:
+            self.unsubscribe(subscriber)
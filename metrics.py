@@ -0,0 +1,169 @@
+'''
+Request metrics and profiling hooks, exposed in Prometheus text format
+
+Threads record into a fixed pool of shards picked by thread id, each with
+its own lock, so concurrent requests rarely contend and nothing is allocated
+per request once a shard has seen a route. A scrape merges the shards.
+'''
+
+import bisect
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+
+# Latency buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Layout of a series: one slot per bucket plus +Inf, then the totals
+SUM = len(BUCKETS) + 1
+COUNT = SUM + 1
+ERRORS = COUNT + 1
+FAILURES = ERRORS + 1
+REQUEST_BYTES = FAILURES + 1
+RESPONSE_BYTES = REQUEST_BYTES + 1
+SERIES_SIZE = RESPONSE_BYTES + 1
+
+
+class Histograms:
+    SHARDS = 16
+
+    def __init__(self):
+        self._shards = [({}, threading.Lock()) for _ in range(self.SHARDS)]  # (series, lock)
+
+    def observe(self, key, seconds, error=False, failed=False, request_bytes=0, response_bytes=0):
+        # Native ids are small sequential integers, unlike get_ident() addresses
+        series, lock = self._shards[threading.get_native_id() % self.SHARDS]
+        with lock:
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0] * SERIES_SIZE
+            values[bisect.bisect_left(BUCKETS, seconds)] += 1
+            values[SUM] += seconds
+            values[COUNT] += 1
+            if error:
+                values[ERRORS] += 1
+            if failed:
+                values[FAILURES] += 1
+            values[REQUEST_BYTES] += request_bytes
+            values[RESPONSE_BYTES] += response_bytes
+
+    def collect(self):
+        merged = {}
+        for series, lock in self._shards:
+            with lock:
+                _merge(merged, series)
+        return merged
+
+
+def _merge(target, series):
+    for key, values in series.items():
+        total = target.get(key)
+        if total is None:
+            target[key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                total[i] += value
+
+
+# Profiles a sampled fraction of requests and dumps the ones slower than the
+# threshold as .prof files, e.g. for `python -m pstats` or snakeviz. Only one
+# request is profiled at a time: from Python 3.12 a profiler is process-wide.
+class SlowRequestProfiler:
+    def __init__(self, threshold, rate, directory):
+        self.threshold = threshold  # Seconds
+        self.rate = rate  # Fraction of requests to profile
+        self.directory = directory
+        self._active = threading.Lock()
+
+    def start(self, state):
+        if random.random() < self.rate and self._active.acquire(blocking=False):
+            state.profile = cProfile.Profile()
+            state.profile.enable()
+
+    def stop(self, state, route, elapsed):
+        profile, state.profile = state.profile, None
+        if profile is None:
+            return
+        profile.disable()
+        self._active.release()
+        if elapsed >= self.threshold:
+            os.makedirs(self.directory, exist_ok=True)
+            slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", route).strip("_") or "index"
+            filename = "%s-%d-%dms.prof" % (slug, time.time() * 1000, elapsed * 1000)
+            profile.dump_stats(os.path.join(self.directory, filename))
+
+
+class Metrics:
+    def __init__(self, profiler=None):
+        self.requests = Histograms()  # Keyed by route
+        self.selections = Histograms()  # Keyed by selection operation
+        self.profiler = profiler
+        self._local = threading.local()  # Start time and profile of the current request
+
+    def request_started(self):
+        state = self._local
+        state.started = time.perf_counter()
+        state.profile = None
+        if self.profiler is not None:
+            self.profiler.start(state)
+
+    def request_finished(self, route, status, request_bytes, response_bytes, failed=False):
+        state = self._local
+        elapsed = time.perf_counter() - state.started
+        self.requests.observe(route, elapsed, status >= 500, failed, request_bytes or 0, response_bytes or 0)
+        if state.profile is not None:
+            self.profiler.stop(state, route, elapsed)
+
+    def render(self, gauges):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        requests = self.requests.collect()
+        _histogram(lines, "name_selector_request_duration_seconds", "Request latency by route.", "route", requests)
+        _counter(lines, "name_selector_requests_total", "Requests by route.", "route", requests, COUNT)
+        _counter(lines, "name_selector_request_errors_total", "Responses with a 5xx status.", "route", requests, ERRORS)
+        _counter(
+            lines, "name_selector_request_failures_total", 'Responses reporting "success": false.', "route",
+            requests, FAILURES,
+        )
+        _counter(lines, "name_selector_request_bytes_total", "Request body bytes.", "route", requests, REQUEST_BYTES)
+        _counter(lines, "name_selector_response_bytes_total", "Response body bytes, when known.", "route", requests, RESPONSE_BYTES)
+        _histogram(
+            lines, "name_selector_select_duration_seconds", "Time spent selecting names.", "op",
+            self.selections.collect(),
+        )
+        for name, (help_text, value) in gauges.items():
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, _number(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram(lines, name, help_text, label, series):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s histogram" % name)
+    for key, values in sorted(series.items()):
+        key = _label(key)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), values):
+            cumulative += count
+            lines.append('%s_bucket{%s="%s",le="%s"} %d' % (name, label, key, bound, cumulative))
+        lines.append('%s_sum{%s="%s"} %s' % (name, label, key, _number(float(values[SUM]))))
+        lines.append('%s_count{%s="%s"} %d' % (name, label, key, values[COUNT]))
+
+
+def _counter(lines, name, help_text, label, series, index):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s counter" % name)
+    for key, values in sorted(series.items()):
+        lines.append('%s{%s="%s"} %d' % (name, label, _label(key), values[index]))
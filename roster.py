@@ -0,0 +1,101 @@
+'''
+Streaming roster formats for bulk import and export
+
+CSV rows are either a bare name or follow a header naming the "name" column
+and optionally "class_name". JSONL lines are either a JSON string or an
+object with "name" and optionally "class_name" strings; anything else is
+rejected. Exports write class_name, name and count for every student.
+'''
+
+import csv
+import io
+import json
+
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+CHUNK_ROWS = 1000  # Rows per chunk written to the response
+
+
+def guess_format(filename, mimetype):
+    if filename and "." in filename:
+        extension = filename.rsplit(".", 1)[1].lower()
+        if extension in ("jsonl", "ndjson", "json"):
+            return "jsonl"
+        if extension in ("csv", "txt"):
+            return "csv"
+    if mimetype and "json" in mimetype:
+        return "jsonl"
+    return "csv"
+
+
+# Yields (class_name or None, name) pairs while reading the byte stream
+def parse_roster(stream, fmt):
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        if fmt == "jsonl":
+            yield from _parse_jsonl(text)
+        else:
+            yield from _parse_csv(text)
+    finally:
+        text.detach()
+
+
+def _parse_csv(text):
+    reader = csv.reader(text)
+    name_column, class_column = 0, None
+    for row in reader:
+        if not row:
+            continue
+        header = [cell.strip().lower() for cell in row]
+        if "name" in header:
+            name_column = header.index("name")
+            class_column = header.index("class_name") if "class_name" in header else None
+            break
+        yield None, row[0].strip()
+        break
+    for row in reader:
+        if len(row) <= name_column:
+            continue
+        class_name = row[class_column].strip() if class_column is not None and len(row) > class_column else None
+        yield class_name or None, row[name_column].strip()
+
+
+def _parse_jsonl(text):
+    for line in text:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if isinstance(record, dict):
+            class_name, name = record.get("class_name"), record.get("name")
+        else:
+            class_name, name = None, record
+        # Anything else would be coerced into an odd name, or fail later unhashable
+        for value in (class_name, name):
+            if value is not None and not isinstance(value, str):
+                raise ValueError("Expected a string, got %s" % type(value).__name__)
+        yield class_name or None, (name or "").strip()
+
+
+# Yields encoded chunks of CSV or JSONL for (class_name, names, counts) items
+def export_roster(items, fmt):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["class_name", "name", "count"])
+        for class_name, names, counts in items:
+            for start in range(0, len(names), CHUNK_ROWS):
+                writer.writerows(
+                    (class_name, name, counts.get(name, 0)) for name in names[start:start + CHUNK_ROWS]
+                )
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+    else:
+        for class_name, names, counts in items:
+            for start in range(0, len(names), CHUNK_ROWS):
+                yield "".join(
+                    json.dumps({"class_name": class_name, "name": name, "count": counts.get(name, 0)}) + "\n"
+                    for name in names[start:start + CHUNK_ROWS]
+                ).encode()
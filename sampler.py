@@ -0,0 +1,197 @@
+'''
+Sampling engines for recency-weighted name selection
+
+Weights follow NameSelector's rule: names that were never selected weigh 1.0,
+and a selected name weighs 1 / rank, where rank 1 is the least recently
+selected name and rank m the most recent of the m selected names. Samplers
+know names only by the integer index NameSelector gives each one.
+'''
+
+from array import array
+import bisect
+import threading
+
+import numpy as np
+
+# Shared harmonic prefix sums: _HARMONIC[k] == 1 + 1/2 + ... + 1/k
+_HARMONIC = [0.0]
+_harmonic_lock = threading.Lock()
+
+
+def harmonic(m):
+    if m >= len(_HARMONIC):
+        with _harmonic_lock:
+            while len(_HARMONIC) <= m:
+                _HARMONIC.append(_HARMONIC[-1] + 1.0 / len(_HARMONIC))
+    return _HARMONIC[m]
+
+
+# Reference engine: rebuilds the weight list on every draw, O(n) per operation
+class LinearSampler:
+    __slots__ = ("indices", "selection_order")
+
+    def __init__(self):
+        self.indices = []
+        self.selection_order = []  # Least recently selected first
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __contains__(self, index):
+        return index in self.indices
+
+    def add(self, index):
+        self.indices.append(index)
+
+    def remove(self, index):
+        self.indices.remove(index)
+        if index in self.selection_order:
+            self.selection_order.remove(index)
+
+    def clear(self):
+        self.indices = []
+        self.selection_order = []
+
+    def touch(self, index):
+        if index in self.selection_order:
+            self.selection_order.remove(index)
+        self.selection_order.append(index)
+
+    def order(self):
+        return list(self.selection_order)
+
+    def draw(self, rng):
+        indices, weights = self.weights()
+        return rng.choices(indices, weights=weights, k=1)[0]
+
+    def weights(self):
+        weights = []
+        for index in self.indices:
+            if index not in self.selection_order:
+                weights.append(1.0)
+            else:
+                weights.append(1 / (self.selection_order.index(index) + 1))
+        return list(self.indices), np.array(weights)
+
+
+# Fenwick tree over "last selected" sequence numbers, O(log n) per operation.
+# A name's rank is the number of occupied sequence slots up to and including
+# its own, so rank lookups and k-th order statistics are prefix-sum queries.
+# State is kept in flat arrays indexed by name index; "i" arrays hold 32-bit
+# indices and occupancy counts.
+class FenwickSampler:
+    __slots__ = ("_seq", "_unselected", "_selected", "_slots", "_tree", "_next")
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self._unselected) + self._selected
+
+    def __contains__(self, index):
+        return 0 <= index < len(self._seq) and self._seq[index] != 0
+
+    def add(self, index):
+        seq = self._seq
+        if index >= len(seq):
+            seq.extend(array("q", [0]) * (index + 1 - len(seq)))
+        seq[index] = -1 - len(self._unselected)
+        self._unselected.append(index)
+
+    def remove(self, index):
+        self._detach(index)
+        self._seq[index] = 0
+
+    def clear(self):
+        # _seq maps a name index to the slot of its last selection, or to
+        # -1 - its position in _unselected if it was never selected; 0 if absent
+        self._seq = array("q")
+        self._unselected = array("i")  # Names never selected, in arbitrary order
+        self._selected = 0
+        self._slots = array("i", [-1])  # slot -> name index (1-based, -1 when vacant)
+        self._tree = array("i", [0])  # Fenwick tree of slot occupancy
+        self._next = 1  # Next free slot
+
+    def touch(self, index):
+        self._detach(index)
+        if self._next >= len(self._tree):
+            self._compact()
+        slot = self._next
+        self._next += 1
+        self._slots[slot] = index
+        self._seq[index] = slot
+        self._selected += 1
+        self._update(slot, 1)
+
+    def order(self):
+        return [index for index in self._slots if index >= 0]
+
+    def draw(self, rng):
+        unselected = len(self._unselected)
+        selected = self._selected
+        r = rng.random() * (unselected + harmonic(selected))
+        if r < unselected:
+            return self._unselected[int(r)]
+        # Rank k is drawn with probability (1/k) / H_m
+        rank = bisect.bisect_right(_HARMONIC, r - unselected, 1, selected + 1)
+        return self._slots[self._find(min(rank, selected))]
+
+    def weights(self):
+        # Unselected names first, then selected names by rank
+        unselected, selected = self._unselected.tolist(), self.order()
+        weights = np.empty(len(unselected) + len(selected))
+        weights[:len(unselected)] = 1.0
+        weights[len(unselected):] = 1.0 / np.arange(1, len(selected) + 1)
+        return unselected + selected, weights
+
+    def _detach(self, index):
+        # Takes a name out of its selection slot or out of _unselected
+        seq = self._seq[index]
+        if seq > 0:
+            self._slots[seq] = -1
+            self._selected -= 1
+            self._update(seq, -1)
+        else:
+            last = self._unselected.pop()
+            if last != index:
+                self._unselected[-1 - seq] = last
+                self._seq[last] = seq
+
+    def _update(self, slot, delta):
+        tree = self._tree
+        while slot < len(tree):
+            tree[slot] += delta
+            slot += slot & -slot
+
+    def _find(self, rank):
+        # Smallest slot whose occupancy prefix sum reaches rank
+        tree = self._tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] < rank:
+                pos = nxt
+                rank -= tree[nxt]
+            step >>= 1
+        return pos + 1
+
+    def _compact(self):
+        # Renumber selected names 1..m and leave a quarter as many free slots
+        # (at least 8), so the O(m) rebuild is amortized over the touches
+        # that follow. _unselected only shrinks here, as arrays keep their
+        # allocation when popped.
+        ordered = self.order()
+        free = max(8, len(ordered) // 4)
+        self._unselected = array("i", self._unselected)
+        self._slots = array("i", [-1]) + array("i", ordered) + array("i", [-1]) * free
+        for slot, index in enumerate(ordered, 1):
+            self._seq[index] = slot
+        capacity = len(ordered) + free
+        tree = array("i", [0]) + array("i", [1]) * len(ordered) + array("i", [0]) * free
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._next = len(ordered) + 1
@@ -0,0 +1,578 @@
+'''
+Persistence engines for the class registry
+
+LogStorage appends every mutation to a write-ahead log and periodically
+compacts the log into a SQLite snapshot on a background thread. A restart
+loads the latest snapshot and replays only the log records written after it.
+
+SharedStorage keeps the state in a SQLite database in WAL mode so several
+worker processes can serve the same classes, each holding a cached copy that
+is refreshed when another worker changes a class.
+
+When the registry has a resident-name cap, cold classes are spilled out of
+memory: the single-process engines write them to a ColdStore, SharedStorage
+just drops its cached copy and reads the class from the database again.
+'''
+
+import fcntl
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zlib
+
+from coldstore import ColdStore, read_state
+
+
+# Single-process engines serialize every mutation behind one lock, which also
+# keeps the in-memory state and the log in the same order
+class Storage:
+    def __init__(self):
+        self._mutex = threading.RLock()
+        self._cold = None
+
+    def lock(self, class_name):
+        return self._mutex
+
+    def registry_lock(self):
+        return self._mutex
+
+    def refresh(self, registry, class_name):
+        pass
+
+    def refresh_classes(self, registry):
+        pass
+
+    # Spilling and filling run under the class lock
+    def spill(self, registry, class_name, selector):
+        self._cold_store().write(class_name, selector)
+        registry.park(class_name, len(selector))
+
+    def fill(self, registry, class_name):
+        registry.restore(class_name, *self.cold_state(class_name))
+        self._cold.remove(class_name)
+
+    def cold_state(self, class_name):
+        return self._cold_store().read(class_name)
+
+    def _cold_store(self):
+        if self._cold is None:
+            self._cold = ColdStore(tempfile.mkdtemp(prefix="name-selector-"))
+        return self._cold
+
+
+# Keeps everything in memory, the behaviour before storage engines existed
+class NullStorage(Storage):
+    def load(self, registry):
+        return False
+
+    def append(self, op, class_name, arg=None):
+        pass
+
+    def snapshot(self):
+        pass
+
+    def close(self):
+        if self._cold is not None:
+            self._cold.close()
+
+
+class LogStorage(Storage):
+    def __init__(self, data_dir, sync_every=256, sync_interval=0.05, snapshot_every=50000):
+        super().__init__()
+        self.data_dir = data_dir
+        self.sync_every = sync_every  # Wake the flusher after this many buffered records
+        self.sync_interval = sync_interval  # ... or fsync after this many seconds anyway
+        self.snapshot_every = snapshot_every  # Compact the log after this many records
+        self._lock = threading.Lock()  # Guards the log file and counters, never held over fsync
+        self._sync_lock = threading.Lock()  # Held over fsync, so the log isn't closed under it
+        self._registry = None
+        self._log = None
+        self._generation = 0  # Log being appended to
+        self._snapshot_generation = 0  # First log not covered by snapshot.db
+        self._records = 0  # Records since the last snapshot started
+        self._pending = 0  # Records written but not yet fsynced
+        self._flusher = None
+        self._wake = threading.Event()  # Asks the flusher to sync now
+        self._snapshotter = None
+        self._snapshot_lock = threading.Lock()  # One snapshot at a time
+        self._closed = False
+
+    def load(self, registry):
+        # Restore the registry from the latest snapshot plus its log tail
+        os.makedirs(self.data_dir, exist_ok=True)
+        self._registry = registry
+        self._cold = ColdStore(os.path.join(self.data_dir, "cold"))
+        restored = False
+        snapshot_path = os.path.join(self.data_dir, "snapshot.db")
+        if os.path.exists(snapshot_path):
+            self._snapshot_generation = self._read_snapshot(snapshot_path, registry)
+            restored = True
+        # A snapshot interrupted by a crash leaves several logs after it
+        self._generation = self._snapshot_generation
+        while True:
+            log_path = self._log_path(self._generation)
+            if os.path.exists(log_path):
+                self._replay(log_path, registry)
+                restored = True
+            if not os.path.exists(self._log_path(self._generation + 1)):
+                break
+            self._generation += 1
+        self._log = open(self._log_path(self._generation), "ab")
+        self._remove_stale_logs()
+        return restored
+
+    def append(self, op, class_name, arg=None):
+        line = json.dumps([op, class_name, arg], separators=(",", ":")) + "\n"
+        with self._lock:
+            self._log.write(line.encode())
+            self._records += 1
+            self._pending += 1
+            if self._pending >= self.sync_every:
+                self._wake.set()
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+            if self._records >= self.snapshot_every and self._snapshotter is None:
+                self._snapshotter = threading.Thread(target=self._snapshot_loop, daemon=True)
+                self._snapshotter.start()
+
+    def snapshot(self):
+        with self._snapshot_lock:
+            # Under the mutation lock, switch to a new log generation and copy
+            # the state it starts from; spilled classes are pinned by hard links
+            cold_dir = os.path.join(self.data_dir, "snapshot-cold")
+            shutil.rmtree(cold_dir, ignore_errors=True)
+            os.makedirs(cold_dir)
+            with self._sync_lock:
+                with self._mutex:
+                    with self._lock:
+                        old_log = self._log
+                        old_log.flush()
+                        generation = self._generation + 1
+                        self._log = open(self._log_path(generation), "ab")
+                        self._generation = generation
+                        self._records = 0
+                        self._pending = 0
+                    classes = self._registry.copy_states()
+                    for class_id, (class_name, state) in enumerate(classes):
+                        if state is None:
+                            self._cold.link(class_name, os.path.join(cold_dir, "%d.cls" % class_id))
+                # The old log is synced once mutations have moved on to the new one
+                os.fsync(old_log.fileno())
+                old_log.close()
+
+            # Mutations carry on in the new log while the snapshot is written
+            path = os.path.join(self.data_dir, "snapshot.db")
+            self._write_snapshot(path + ".tmp", generation, classes, cold_dir)
+            os.replace(path + ".tmp", path)
+            self._fsync_dir()
+            shutil.rmtree(cold_dir, ignore_errors=True)
+            self._snapshot_generation = generation
+            self._remove_stale_logs()
+
+    def close(self):
+        snapshotter = self._snapshotter
+        if snapshotter is not None:
+            snapshotter.join()
+        with self._sync_lock, self._lock:
+            if self._log is not None and not self._closed:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+            self._closed = True
+        self._wake.set()
+        if self._cold is not None:
+            self._cold.close()
+
+    def _sync(self):
+        # Flushes the buffer under _lock, then fsyncs with only _sync_lock held
+        # so appends carry on while the disk catches up
+        with self._sync_lock:
+            with self._lock:
+                if not self._pending or self._closed:
+                    return
+                self._log.flush()
+                fd = self._log.fileno()
+                self._pending = 0
+            os.fsync(fd)
+
+    def _snapshot_loop(self):
+        try:
+            self.snapshot()
+        finally:
+            self._snapshotter = None
+
+    def _replay(self, log_path, registry):
+        valid = 0
+        with open(log_path, "rb+") as log:
+            for line in log:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError(line)
+                    op, class_name, arg = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of the log, drop it
+                    log.truncate(valid)
+                    break
+                registry.apply(op, class_name, arg)
+                registry.evict()
+                valid += len(line)
+                self._records += 1
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+            self._sync()
+
+    def _log_path(self, generation):
+        return os.path.join(self.data_dir, "wal-%d.log" % generation)
+
+    def _remove_stale_logs(self):
+        # Logs before the snapshot's generation are covered by it
+        for entry in os.listdir(self.data_dir):
+            if entry.startswith("wal-") and entry.endswith(".log"):
+                if int(entry[4:-4]) < self._snapshot_generation:
+                    os.remove(os.path.join(self.data_dir, entry))
+
+    def _fsync_dir(self):
+        fd = os.open(self.data_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_snapshot(self, path, generation, classes, cold_dir):
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        try:
+            db.executescript("""
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = FULL;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER);
+                CREATE TABLE classes (id INTEGER PRIMARY KEY, name TEXT, token TEXT, version INTEGER);
+                CREATE TABLE names (
+                    class_id INTEGER, position INTEGER, name TEXT,
+                    count INTEGER, recency INTEGER
+                );
+            """)
+            db.execute("INSERT INTO meta VALUES ('generation', ?)", (generation,))
+            for class_id, (class_name, state) in enumerate(classes):
+                if state is None:
+                    state = read_state(os.path.join(cold_dir, "%d.cls" % class_id))
+                names, counts, order, token, version = state
+                db.execute("INSERT INTO classes VALUES (?, ?, ?, ?)", (class_id, class_name, token, version))
+                recency = {name: rank for rank, name in enumerate(order)}
+                db.executemany(
+                    "INSERT INTO names VALUES (?, ?, ?, ?, ?)",
+                    ((class_id, position, name, counts[name], recency.get(name))
+                     for position, name in enumerate(names)),
+                )
+            db.commit()
+        finally:
+            db.close()
+
+    def _read_snapshot(self, path, registry):
+        db = sqlite3.connect(path)
+        try:
+            generation = db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            classes = db.execute("SELECT id, name, token, version FROM classes ORDER BY id").fetchall()
+            # One class at a time, so classes over the resident cap are spilled as they load
+            groups = itertools.groupby(
+                db.execute("SELECT class_id, name, count, recency FROM names ORDER BY class_id, position"),
+                key=lambda row: row[0],
+            )
+            group = next(groups, None)
+            for class_id, class_name, token, version in classes:
+                class_rows = []
+                if group is not None and group[0] == class_id:
+                    class_rows = list(group[1])
+                    group = next(groups, None)
+                order = sorted((row for row in class_rows if row[3] is not None), key=lambda row: row[3])
+                registry.restore(
+                    class_name,
+                    [row[1] for row in class_rows],
+                    {row[1]: row[2] for row in class_rows},
+                    [row[1] for row in order],
+                    token,
+                    version,
+                )
+                registry.evict()
+        finally:
+            db.close()
+        return generation
+
+
+# Cross-process lock: a thread lock inside this worker plus an advisory flock
+# on a lock file shared by all workers
+class _ClassLock:
+    def __init__(self, path):
+        self._thread_lock = threading.RLock()
+        self._path = path
+        self._fd = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            if self._fd is None:
+                self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+class SharedStorage(Storage):
+    LOCK_STRIPES = 128
+
+    def __init__(self, data_dir, busy_timeout=30.0):
+        super().__init__()
+        self.data_dir = data_dir
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()  # One SQLite connection per thread
+        # Classes hash onto a fixed set of lock files, so open descriptors and
+        # files on disk don't grow with the number of classes ever created
+        locks_dir = os.path.join(data_dir, "locks")
+        self._locks = [
+            _ClassLock(os.path.join(locks_dir, "stripe-%d.lock" % i)) for i in range(self.LOCK_STRIPES)
+        ]
+        self._registry_lock = _ClassLock(os.path.join(locks_dir, "registry.lock"))
+        self._cache_lock = threading.Lock()  # Guards reloads of cached selectors
+        self._versions = {}  # class -> version of the cached selector
+        self._next_seq = {}  # class -> next name position / selection sequence
+        self._registry_version = None
+
+    def load(self, registry):
+        os.makedirs(os.path.join(self.data_dir, "locks"), exist_ok=True)
+        with self.registry_lock():
+            db = self._db()
+            with db:
+                db.executescript("""
+                    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+                    INSERT OR IGNORE INTO meta VALUES ('registry_version', 0);
+                    CREATE TABLE IF NOT EXISTS classes (
+                        name TEXT PRIMARY KEY, position INTEGER, version INTEGER,
+                        token TEXT, next_seq INTEGER
+                    );
+                    CREATE TABLE IF NOT EXISTS names (
+                        class TEXT, name TEXT, position INTEGER, count INTEGER, seq INTEGER,
+                        PRIMARY KEY (class, name)
+                    );
+                """)
+            self.refresh_classes(registry)
+        return len(registry) > 0
+
+    def lock(self, class_name):
+        # Only rename holds two class locks, and it holds the registry lock
+        # first, so classes sharing a stripe can't deadlock
+        return self._locks[zlib.crc32(class_name.encode()) % self.LOCK_STRIPES]
+
+    def registry_lock(self):
+        return self._registry_lock
+
+    def refresh(self, registry, class_name):
+        query = "SELECT version FROM classes WHERE name = ?"
+        row = self._db().execute(query, (class_name,)).fetchone()
+        if (row[0] if row is not None else None) == self._versions.get(class_name):
+            return
+        # Reload under the class lock, so it can't land between this worker's
+        # own write and the in-memory apply; the row may be stale by then
+        with self.lock(class_name), self._cache_lock:
+            row = self._db().execute(query, (class_name,)).fetchone()
+            if row is None:
+                if class_name in self._versions:
+                    self._forget(class_name)
+                    registry.unload(class_name)
+            elif self._versions.get(class_name) != row[0]:
+                self._reload(registry, class_name)
+
+    def refresh_classes(self, registry):
+        db = self._db()
+        version = db.execute("SELECT value FROM meta WHERE key = 'registry_version'").fetchone()[0]
+        if version == self._registry_version:
+            return
+        rows = db.execute("SELECT name, version FROM classes ORDER BY position").fetchall()
+        # Reloads take class locks, which are never taken while holding _cache_lock
+        for class_name, class_version in rows:
+            if class_name in self._versions or registry.max_resident_names is None:
+                if self._versions.get(class_name) != class_version:
+                    self.refresh(registry, class_name)
+        with self._cache_lock:
+            for class_name in set(self._versions) - {row[0] for row in rows}:
+                self._forget(class_name)
+                registry.unload(class_name)
+            for class_name, _ in rows:
+                # Under a resident cap, classes new to this worker are loaded when first used
+                if class_name not in registry and registry.max_resident_names is not None:
+                    size = db.execute("SELECT COUNT(*) FROM names WHERE class = ?", (class_name,)).fetchone()[0]
+                    registry.park(class_name, size)
+            registry.reorder([row[0] for row in rows])
+            self._registry_version = version
+
+    def append(self, op, class_name, arg=None):
+        # Callers hold the class lock (and the registry lock for class-level
+        # operations) and have refreshed the class first
+        db = self._db()
+        with db:
+            if op == "create_class":
+                db.execute(
+                    "INSERT INTO classes VALUES "
+                    "(?, (SELECT IFNULL(MAX(position), 0) + 1 FROM classes), 0, ?, 0)",
+                    (class_name, arg),
+                )
+                self._bump_registry(db)
+            elif op == "delete_class":
+                db.execute("DELETE FROM classes WHERE name = ?", (class_name,))
+                db.execute("DELETE FROM names WHERE class = ?", (class_name,))
+                self._bump_registry(db)
+            elif op == "edit_class":
+                db.execute(
+                    "UPDATE classes SET name = ?, position = (SELECT MAX(position) + 1 FROM classes) WHERE name = ?",
+                    (arg, class_name),
+                )
+                db.execute("UPDATE names SET class = ? WHERE class = ?", (arg, class_name))
+                self._bump_registry(db)
+            else:
+                version, seq = self._write_names(db, op, class_name, arg)
+
+        # The cached versions only follow a committed transaction
+        if op == "create_class":
+            self._versions[class_name] = 0
+            self._next_seq[class_name] = 0
+        elif op == "delete_class":
+            self._forget(class_name)
+        elif op == "edit_class":
+            self._versions[arg] = self._versions.pop(class_name)
+            self._next_seq[arg] = self._next_seq.pop(class_name)
+        else:
+            self._versions[class_name] = version
+            self._next_seq[class_name] = seq
+
+    def _write_names(self, db, op, class_name, arg):
+        # One version per operation, matching NameSelector.record_change;
+        # names take positions and selection sequence numbers from next_seq
+        version = self._versions[class_name] + 1
+        seq = self._next_seq[class_name]
+        if op == "add_name":
+            db.execute("INSERT INTO names VALUES (?, ?, ?, 0, NULL)", (class_name, arg, seq))
+            seq += 1
+        elif op == "add_names":
+            db.executemany(
+                "INSERT INTO names VALUES (?, ?, ?, 0, NULL)",
+                ((class_name, name, seq + i) for i, name in enumerate(arg)),
+            )
+            seq += len(arg)
+        elif op == "delete_name":
+            db.execute("DELETE FROM names WHERE class = ? AND name = ?", (class_name, arg))
+        elif op == "select_name":
+            db.execute(
+                "UPDATE names SET count = count + 1, seq = ? WHERE class = ? AND name = ?",
+                (seq, class_name, arg),
+            )
+            seq += 1
+        elif op == "select_names":
+            db.executemany(
+                "UPDATE names SET count = count + 1, seq = ? WHERE class = ? AND name = ?",
+                ((seq + i, class_name, name) for i, name in enumerate(arg)),
+            )
+            seq += len(arg)
+        elif op == "reset":
+            db.execute("DELETE FROM names WHERE class = ?", (class_name,))
+        db.execute(
+            "UPDATE classes SET version = ?, next_seq = ? WHERE name = ?",
+            (version, seq, class_name),
+        )
+        return version, seq
+
+    def snapshot(self):
+        pass  # SQLite checkpoints its own WAL
+
+    # The database holds every class, so spilling only drops the cached copy
+    def spill(self, registry, class_name, selector):
+        with self._cache_lock:
+            self._forget(class_name)
+            registry.park(class_name, len(selector))
+
+    def fill(self, registry, class_name):
+        with self._cache_lock:
+            if not self._reload(registry, class_name):
+                registry.unload(class_name)
+
+    def cold_state(self, class_name):
+        state = self._read(class_name)
+        return state[0] if state is not None else ([], {}, [], None, 0)
+
+    def close(self):
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(
+                os.path.join(self.data_dir, "classes.db"),
+                timeout=self.busy_timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.isolation_level = "IMMEDIATE"
+            self._local.db = db
+        return db
+
+    def _bump_registry(self, db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'registry_version'")
+        self._registry_version = None  # Reorder on the next refresh_classes
+
+    def _reload(self, registry, class_name):
+        state = self._read(class_name)
+        if state is None:
+            return False
+        registry.restore(class_name, *state[0])
+        self._versions[class_name], self._next_seq[class_name] = state[1]
+        return True
+
+    def _read(self, class_name):
+        # Read the class row and its names in one transaction so they agree
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            row = db.execute(
+                "SELECT version, token, next_seq FROM classes WHERE name = ?", (class_name,)
+            ).fetchone()
+            rows = db.execute(
+                "SELECT name, count, seq FROM names WHERE class = ? ORDER BY position",
+                (class_name,),
+            ).fetchall()
+        finally:
+            db.execute("COMMIT")
+        if row is None:
+            return None
+        version, token, next_seq = row
+        order = sorted((row for row in rows if row[2] is not None), key=lambda row: row[2])
+        state = (
+            [row[0] for row in rows],
+            {row[0]: row[1] for row in rows},
+            [row[0] for row in order],
+            token,
+            version,
+        )
+        return state, (version, next_seq)
+
+    def _forget(self, class_name):
+        self._versions.pop(class_name, None)
+        self._next_seq.pop(class_name, None)
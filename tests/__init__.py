@@ -0,0 +1,10 @@
+'''
+Regression tests, run with `python -m pytest` or `python -m unittest`
+
+Importing app builds the module-level registry, so keep it in memory rather
+than in the instance folder.
+'''
+
+import os
+
+os.environ.setdefault("NAME_SELECTOR_STORAGE", "memory")
@@ -0,0 +1,89 @@
+import unittest
+
+import app
+from app import ClassRegistry
+
+
+class ClassStateTest(unittest.TestCase):
+    def setUp(self):
+        registry, app.classes = app.classes, ClassRegistry()
+        self.addCleanup(setattr, app, "classes", registry)
+        self.classes = app.classes
+        self.classes.create("Class")
+        self.classes.add_names("Class", ["Ada", "Grace", "Alan"])
+        self.client = app.app.test_client()
+
+    def fetch(self, since=None, token=None, etag=None):
+        query = {"class_name": "Class"}
+        if since is not None:
+            query["since"], query["token"] = since, token
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.client.get("/class_state", query_string=query, headers=headers)
+
+    def test_full_then_delta(self):
+        state = self.fetch().get_json()
+        self.assertTrue(state["full"])
+        self.assertEqual(state["counts"], {"Ada": 0, "Grace": 0, "Alan": 0})
+        self.classes.add_name("Class", "Edsger")
+        self.classes.delete_name("Class", "Grace")
+        delta = self.fetch(state["version"], state["token"]).get_json()
+        self.assertFalse(delta["full"])
+        self.assertEqual(delta["since"], state["version"])
+        self.assertEqual(delta["changed"], [["Edsger", 0]])
+        self.assertEqual(delta["deleted"], ["Grace"])
+        self.assertEqual(delta["version"], state["version"] + 2)
+
+    def test_delete_then_add_again(self):
+        state = self.fetch().get_json()
+        self.classes.select_names("Class", 3)
+        self.classes.delete_name("Class", "Ada")
+        self.classes.add_name("Class", "Ada")
+        delta = self.fetch(state["version"], state["token"]).get_json()
+        self.assertEqual(delta["deleted"], [])
+        self.assertEqual(delta["changed"], [["Grace", 1], ["Alan", 1], ["Ada", 0]])
+
+    def test_reset_sends_the_full_state(self):
+        state = self.fetch().get_json()
+        self.classes.reset("Class")
+        self.classes.add_name("Class", "Ada")
+        after = self.fetch(state["version"], state["token"]).get_json()
+        self.assertTrue(after["full"])
+        self.assertEqual(after["counts"], {"Ada": 0})
+        # Versions after the reset are known again
+        self.classes.select_name("Class")
+        delta = self.fetch(after["version"], after["token"]).get_json()
+        self.assertEqual(delta["changed"], [["Ada", 1]])
+
+    def test_forgotten_changes_send_the_full_state(self):
+        state = self.fetch().get_json()
+        for _ in range(3 * app.NameSelector.MIN_CHANGES):
+            self.classes.select_name("Class")
+        self.assertTrue(self.fetch(state["version"], state["token"]).get_json()["full"])
+
+    def test_token_mismatch_sends_the_full_state(self):
+        state = self.fetch().get_json()
+        self.classes.delete("Class")
+        self.classes.create("Class")
+        self.classes.add_name("Class", "Ada")
+        after = self.fetch(state["version"], state["token"]).get_json()
+        self.assertTrue(after["full"])
+        self.assertNotEqual(after["token"], state["token"])
+        self.assertEqual(after["names"], ["Ada"])
+
+    def test_not_modified(self):
+        response = self.fetch()
+        etag = response.headers["ETag"].strip('"')
+        self.assertEqual(etag, "%s-%d" % (response.get_json()["token"], response.get_json()["version"]))
+        cached = self.fetch(etag=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.headers["ETag"].strip('"'), etag)
+        self.classes.select_name("Class")
+        self.assertEqual(self.fetch(etag=etag).status_code, 200)
+
+    def test_unknown_class(self):
+        response = self.client.get("/class_state", query_string={"class_name": "Missing"})
+        self.assertEqual(response.get_json(), {"success": False, "error": "Class not found"})
+
+
+if __name__ == "__main__":
+    unittest.main()
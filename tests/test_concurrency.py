@@ -0,0 +1,87 @@
+import random
+import sys
+import threading
+import unittest
+
+import app
+from app import ClassRegistry
+
+
+class ConcurrentReadTest(unittest.TestCase):
+    # One writer adds, deletes and selects while readers copy names and counts
+    WRITES = 20000
+    READERS = 4
+
+    def setUp(self):
+        # Switch threads often so reads land in the middle of mutations
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        self.registry = ClassRegistry()
+        self.registry.create("Class")
+        self.errors = []
+        self.done = threading.Event()
+
+    def run_threads(self, reader):
+        threads = [threading.Thread(target=self.write)]
+        threads += [threading.Thread(target=self.guard, args=(reader,)) for _ in range(self.READERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+
+        selector = self.registry.get("Class")
+        indices = selector.sampler.order() + selector.sampler._unselected.tolist()
+        sampled = sorted(selector._names[index] for index in indices)
+        self.assertEqual(sorted(selector.names), sampled)
+        self.assertEqual(sorted(selector.selection_counts), sampled)
+
+    def write(self):
+        rng = random.Random(0)
+        try:
+            for _ in range(self.WRITES):
+                name = "n%d" % rng.randrange(60)
+                op = rng.random()
+                if op < 0.4:
+                    self.registry.add_name("Class", name)
+                elif op < 0.7:
+                    self.registry.delete_name("Class", name)
+                else:
+                    self.registry.select_name("Class")
+        except Exception as e:
+            self.errors.append(repr(e))
+        finally:
+            self.done.set()
+
+    def guard(self, reader):
+        try:
+            while not self.done.is_set():
+                reader()
+        except Exception as e:
+            self.errors.append(repr(e))
+
+    def test_registry_reads(self):
+        def reader():
+            selector = self.registry.get("Class")
+            self.assertNotIn(None, selector.names)
+            self.assertNotIn(None, selector.selection_counts)
+
+        self.run_threads(reader)
+
+    def test_route_reads(self):
+        client = app.app.test_client()
+        registry, app.classes = app.classes, self.registry
+        self.addCleanup(setattr, app, "classes", registry)
+
+        def reader():
+            names = client.get("/get_names", query_string={"class_name": "Class"}).get_json()
+            counts = client.get("/get_counts", query_string={"class_name": "Class"}).get_json()
+            self.assertNotIn(None, names)
+            self.assertTrue(all(count >= 0 for count in counts.values()))
+
+        self.run_threads(reader)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import io
+import unittest
+
+import app
+import roster
+from app import ClassRegistry
+
+
+def parse(text, fmt):
+    return list(roster.parse_roster(io.BytesIO(text.encode("utf-8")), fmt))
+
+
+class ParseCsvTest(unittest.TestCase):
+    def test_bare_names(self):
+        # Without a header naming "name", the first row is a student too
+        self.assertEqual(parse("Ada\nGrace, x\n\nAlan\n", "csv"), [(None, "Ada"), (None, "Grace"), (None, "Alan")])
+
+    def test_header_columns(self):
+        text = "id,Name,class_name\n1, Ada ,Math\n2,Grace,\n3\n"
+        self.assertEqual(parse(text, "csv"), [("Math", "Ada"), (None, "Grace")])
+
+    def test_header_after_byte_order_mark(self):
+        self.assertEqual(parse("\ufeffname\nAda\n", "csv"), [(None, "Ada")])
+
+
+class ParseJsonlTest(unittest.TestCase):
+    def test_strings_and_objects(self):
+        text = '"Ada"\n\n{"name": " Grace ", "class_name": "Math"}\n{"class_name": "Math"}\nnull\n'
+        self.assertEqual(parse(text, "jsonl"), [(None, "Ada"), ("Math", "Grace"), ("Math", ""), (None, "")])
+
+    def test_non_strings_are_rejected(self):
+        for line in ('{"name": ["Ada"]}', '{"name": {"first": "Ada"}}', '{"name": "Ada", "class_name": 3}', "42"):
+            with self.subTest(line=line), self.assertRaises(ValueError):
+                parse(line, "jsonl")
+
+
+class ImportRosterTest(unittest.TestCase):
+    def setUp(self):
+        registry, app.classes = app.classes, ClassRegistry()
+        self.addCleanup(setattr, app, "classes", registry)
+        app.classes.create("Class")
+        self.client = app.app.test_client()
+
+    def upload(self, text, filename):
+        data = {"class_name": "Class", "file": (io.BytesIO(text.encode("utf-8")), filename)}
+        return self.client.post("/import_roster", data=data).get_json()
+
+    def test_repeats_are_added_once(self):
+        app.classes.add_name("Class", "Ada")
+        response = self.upload("name,class_name\nAda,\nGrace,\nGrace,\nAlan,Math\nAlan,Math\n", "roster.csv")
+        self.assertEqual(response["added"], {"Class": 1, "Math": 1})
+        self.assertEqual(app.classes.get("Class").names, ["Ada", "Grace"])
+        self.assertEqual(app.classes.get("Math").names, ["Alan"])
+
+    def test_bad_jsonl_is_a_parse_error(self):
+        response = self.upload('{"name": "Ada"}\n{"name": ["Grace"]}\n', "roster.jsonl")
+        self.assertEqual(response, {"success": False, "error": "Could not parse roster"})
+        self.assertEqual(app.classes.get("Class").names, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
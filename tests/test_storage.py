@@ -0,0 +1,190 @@
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+from app import ClassRegistry
+from storage import LogStorage, SharedStorage
+
+
+def build(registry, seed=0):
+    # A few classes with adds, deletes, selections and a rename
+    rng = random.Random(seed)
+    for i in range(4):
+        class_name = "Class %d" % i
+        registry.create(class_name)
+        registry.add_names(class_name, ["Student %d" % j for j in range(12)])
+        for _ in range(20):
+            registry.select_name(class_name)
+        registry.delete_name(class_name, "Student %d" % rng.randrange(12))
+    registry.select_names("Class 1", 5, replace=True)
+    registry.rename("Class 2", "Renamed")
+    registry.delete("Class 3")
+
+
+def state(registry):
+    return {
+        class_name: (
+            selector.names, selector.selection_counts, selector.selection_order,
+            selector.token, selector.version,
+        )
+        for class_name, selector in registry.items()
+    }
+
+
+def reopen(storage_type, data_dir, **kwargs):
+    registry = ClassRegistry(storage_type(data_dir), **kwargs)
+    registry.storage.load(registry)
+    return registry
+
+
+class LogStorageTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.data_dir = self._tmp.name
+        self.registry = reopen(LogStorage, self.data_dir)
+
+    def tearDown(self):
+        self.registry.storage.close()
+        self._tmp.cleanup()
+
+    def restart(self, **kwargs):
+        expected = state(self.registry)
+        self.registry.storage.close()
+        self.registry = reopen(LogStorage, self.data_dir, **kwargs)
+        self.assertEqual(state(self.registry), expected)
+
+    def test_log_replay(self):
+        build(self.registry)
+        self.restart()
+
+    def test_snapshot_then_log(self):
+        build(self.registry)
+        self.registry.storage.snapshot()
+        self.registry.select_name("Class 0")
+        self.registry.add_name("Renamed", "Late")
+        self.restart()
+        logs = [entry for entry in os.listdir(self.data_dir) if entry.startswith("wal-")]
+        self.assertEqual(logs, ["wal-1.log"])
+
+    def test_background_snapshot(self):
+        self.registry.storage.snapshot_every = 50
+        build(self.registry)
+        snapshotter = self.registry.storage._snapshotter
+        if snapshotter is not None:
+            snapshotter.join()
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, "snapshot.db")))
+        self.restart()
+
+    def test_torn_tail_is_truncated(self):
+        build(self.registry)
+        expected = state(self.registry)
+        self.registry.storage.close()
+        log_path = os.path.join(self.data_dir, "wal-0.log")
+        size = os.path.getsize(log_path)
+        with open(log_path, "ab") as log:
+            log.write(b'["select_name","Class 0","Stud')
+        self.registry = reopen(LogStorage, self.data_dir)
+        self.assertEqual(state(self.registry), expected)
+        self.assertEqual(os.path.getsize(log_path), size)
+        self.registry.select_name("Class 0")  # Appends after the truncated tail
+        self.restart()
+
+    def test_spilled_classes(self):
+        self.registry.storage.close()
+        self.registry = reopen(LogStorage, self.data_dir, max_resident_names=20)
+        build(self.registry)
+        self.registry.storage.snapshot()
+        self.registry.add_name("Class 0", "Late")
+        self.restart(max_resident_names=20)
+
+
+class _StaleOnce:
+    # A connection whose first version query answers with an old version,
+    # like a reader that checked the class just before a write
+    def __init__(self, db, version):
+        self._db = db
+        self._version = version
+
+    def execute(self, sql, params=()):
+        if self._version is not None and sql.startswith("SELECT version FROM classes"):
+            version, self._version = self._version, None
+            return _Rows([(version,)])
+        return self._db.execute(sql, params)
+
+
+class _Rows:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+class SharedStorageTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.data_dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_round_trip(self):
+        registry = reopen(SharedStorage, self.data_dir)
+        build(registry)
+        expected = state(registry)
+        registry.storage.close()
+        registry = reopen(SharedStorage, self.data_dir)
+        self.assertEqual(state(registry), expected)
+        registry.storage.close()
+
+    def test_reload_waits_for_mutation(self):
+        registry = reopen(SharedStorage, self.data_dir)
+        registry.create("Class")
+        registry.add_names("Class", ["a", "b"])
+        storage = registry.storage
+        stale_version = storage._versions["Class"]
+
+        def read():
+            storage._local.db = _StaleOnce(storage._db(), stale_version - 1)
+            registry.get("Class")
+
+        # A reader with a stale version row arrives between the write and the apply
+        reader = threading.Thread(target=read)
+        append = storage.append
+
+        def append_then_read(*args):
+            append(*args)
+            reader.start()
+            reader.join(0.2)
+
+        storage.append = append_then_read
+        registry.select_name("Class")
+        reader.join()
+        del storage.append
+
+        fresh = reopen(SharedStorage, self.data_dir)
+        self.assertEqual(state(registry), state(fresh))
+        self.assertEqual(sum(registry.get("Class").selection_counts.values()), 1)
+        registry.storage.close()
+        fresh.storage.close()
+
+    def test_workers_see_each_other(self):
+        # Two storages on one directory stand in for two worker processes
+        first = reopen(SharedStorage, self.data_dir)
+        second = reopen(SharedStorage, self.data_dir, max_resident_names=20)
+        build(first)
+        self.assertEqual(second.keys(), first.keys())
+        for _ in range(10):
+            second.select_name("Class 0")
+        second.add_name("Renamed", "Late")
+        first.get("Class 0")
+        first.get("Renamed")
+        self.assertEqual(state(first), state(second))
+        first.storage.close()
+        second.storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()